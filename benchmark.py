@@ -0,0 +1,257 @@
+import argparse
+import os
+import subprocess
+import time
+import tracemalloc
+import types
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import functions
+
+
+# ----------------------------------------------------------------------------------------------------
+# Benchmarks for the payload parsing layer, run offline with synthetic payloads:
+#     python benchmark.py --sizes 10000 1000000 10000000 > bench_output.txt
+# ----------------------------------------------------------------------------------------------------
+
+# Frame type nibble of every name accepted in a mix
+FRAME_NIBBLES = {
+    "info": 0x0,
+    "keepalive": 0x1,
+    "config": 0x2,
+    "start1": 0x4,
+    "start2": 0x5,
+    "rtc": 0x7,
+}
+
+# Share of every frame type in a typical day of fleet traffic
+DEFAULT_MIX = {
+    "info": 0.55,
+    "keepalive": 0.35,
+    "config": 0.01,
+    "start1": 0.02,
+    "start2": 0.02,
+    "rtc": 0.05,
+}
+
+# Two lowercase hex characters of every byte value, as ASCII codes
+_HEX_ASCII = np.array(
+    [[ord(char) for char in "{:02x}".format(value)] for value in range(256)], dtype=np.uint8
+)
+
+
+def parse_mix(text):
+    """
+    Turn "info=0.6,keepalive=0.4" into a frame mix dict.
+    """
+    mix = {}
+    for item in text.split(","):
+        name, share = item.split("=")
+        if name not in FRAME_NIBBLES:
+            raise ValueError("Unknown frame type {}, use one of {}".format(name, list(FRAME_NIBBLES)))
+        mix[name] = float(share)
+    return mix
+
+
+def synthetic_payloads(n, mix=None, seed=0, full_length=False):
+    """
+    Seeded hex payloads of every frame type, with realistic field values
+    and the length each frame layout needs, or all PAYLOAD_BYTES bytes
+    with full_length.
+    """
+    mix = DEFAULT_MIX if mix is None else mix
+    rng = np.random.default_rng(seed)
+
+    names = list(mix)
+    shares = np.array([mix[name] for name in names], dtype=float)
+    frames = np.array([FRAME_NIBBLES[name] for name in names], dtype=np.uint8)
+    frame = frames[rng.choice(len(names), size=n, p=shares / shares.sum())]
+
+    # Mostly unoccupied bays with a good battery, occasional flags
+    flags = (
+        (rng.random(n) < 0.4) * 8
+        + (rng.random(n) < 0.05) * 4
+        + (rng.random(n) < 0.02) * 2
+        + (rng.random(n) < 0.01) * 1
+    ).astype(np.uint8)
+
+    data = rng.integers(0, 256, size=(n, functions.PAYLOAD_BYTES), dtype=np.uint8)
+    data[:, 0] = (flags << 4) | frame
+    data[:, 1] = np.arange(n) % 256
+
+    status = np.isin(frame, [0x0, 0x1, 0x7])
+    data[status, 2] = rng.random(status.sum()) < 0.01
+    data[status, 3] = rng.integers(5, 45, status.sum())
+    data[status, 4] = rng.integers(0, 24, status.sum())
+    data[status, 5] = rng.integers(0, 60, status.sum())
+    data[status, 6] = rng.integers(100, 250, status.sum())
+
+    start1 = frame == 0x4
+    data[start1, 2] = rng.integers(31, 35, start1.sum())
+    data[start1, 3] = rng.integers(100, 250, start1.sum())
+
+    # Bytes past the layout length become NUL and are dropped from the text
+    n_bytes = functions._required_bytes()[frame]
+    if full_length:
+        n_bytes = np.full(n, functions.PAYLOAD_BYTES)
+    data[np.arange(functions.PAYLOAD_BYTES) >= n_bytes[:, None]] = 0
+    ascii_codes = _HEX_ASCII[data].reshape(n, -1)
+    ascii_codes[np.arange(2 * functions.PAYLOAD_BYTES) >= 2 * n_bytes[:, None]] = 0
+
+    text = ascii_codes.view("S{}".format(2 * functions.PAYLOAD_BYTES)).ravel()
+    return pd.Series(text.astype(str), dtype=object)
+
+
+def load_baseline(revision=None):
+    """
+    functions.py as it was at a git revision, by default the first commit,
+    loaded as a module so the row-wise parser the bulk decoder replaced is
+    timed as it shipped. None when git or the revision is not available.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        if revision is None:
+            revision = _git(root, "rev-list", "--max-parents=0", "HEAD").split()[0]
+        source = _git(root, "show", "{}:functions.py".format(revision))
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        return None
+
+    module = types.ModuleType("baseline_functions")
+    module.__file__ = "{}:functions.py".format(revision)
+    exec(compile(source, module.__file__, "exec"), module.__dict__)
+    return module
+
+
+def _git(root, *args):
+    return subprocess.run(
+        ["git", "-C", root, *args], capture_output=True, text=True, check=True
+    ).stdout
+
+
+def _apply(function, payloads):
+    payloads.apply(function)
+
+
+def _per_row_parsers(payloads):
+    for row in payloads:
+        functions.parse_header(row)
+        functions.parse_sequence(row)
+        functions.validate_voltage(row)
+        if row[1] in "017":
+            # Only info, keep-alive and RTC frames carry a temperature
+            functions.validate_temperature(row)
+
+
+def _decode_records_cached(payloads):
+    functions.decode_records(payloads, cache=functions.DecodeCache())
+
+
+# Benchmark cases: (name, per-row, full length payloads, function of a payload Series)
+CASES = [
+    ("main_function apply", True, False, partial(_apply, functions.main_function)),
+    ("per-row header/seq/battery/temp", True, False, _per_row_parsers),
+    ("decode_records", True, False, functions.decode_records),
+    ("decode_records cached", True, False, _decode_records_cached),
+    ("validate_payloads", False, False, functions.validate_payloads),
+    ("decode_payloads", False, False, functions.decode_payloads),
+]
+
+
+def benchmark_cases(baseline=None):
+    """
+    CASES, led by the main_function of a load_baseline module when given.
+    The baseline parser reads every field of every frame, so it gets full
+    length payloads.
+    """
+    if baseline is None:
+        return CASES
+    apply_baseline = partial(_apply, baseline.main_function)
+    return [("baseline main_function apply", True, True, apply_baseline)] + CASES
+
+
+def run_case(function, payloads, memory=True):
+    """
+    Wall time of one call and, when asked, its traced peak memory in bytes.
+    """
+    start = time.perf_counter()
+    function(payloads)
+    elapsed = time.perf_counter() - start
+
+    peak = np.nan
+    if memory:
+        tracemalloc.start()
+        try:
+            function(payloads)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def run_benchmarks(sizes, mix=None, seed=0, per_row_limit=100000, memory=True, baseline=None):
+    """
+    Time every case at every size, and the baseline module when given.
+    Per-row cases run on at most per_row_limit payloads; throughput is
+    payloads per second either way.
+    """
+    cases = benchmark_cases(baseline)
+    results = []
+    for size in sizes:
+        payloads = {
+            full_length: synthetic_payloads(size, mix, seed, full_length)
+            for full_length in {case[2] for case in cases}
+        }
+        for name, per_row, full_length, function in cases:
+            rows = min(size, per_row_limit) if per_row else size
+            elapsed, peak = run_case(function, payloads[full_length].iloc[:rows], memory)
+            results.append(
+                {
+                    "case": name,
+                    "size": size,
+                    "rows_timed": rows,
+                    "seconds": round(elapsed, 4),
+                    "payloads_per_s": int(rows / elapsed) if elapsed else np.nan,
+                    "peak_mb": round(peak / 2**20, 2),
+                }
+            )
+            print(results[-1], flush=True)
+
+    return pd.DataFrame(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the payload parsing layer")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 1000000, 10000000])
+    parser.add_argument("--mix", type=parse_mix, default=None, help="e.g. info=0.6,keepalive=0.4")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--per-row-limit", type=int, default=100000)
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced peak memory run")
+    parser.add_argument(
+        "--baseline", default=None, help="git revision of the baseline (default: first commit)"
+    )
+    parser.add_argument("--no-baseline", action="store_true", help="skip the baseline case")
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.no_baseline:
+        baseline = load_baseline(args.baseline)
+        if baseline is None:
+            print("Baseline functions.py not found in git, skipping the baseline case")
+
+    results = run_benchmarks(
+        args.sizes,
+        args.mix,
+        args.seed,
+        args.per_row_limit,
+        memory=not args.no_memory,
+        baseline=baseline,
+    )
+    print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
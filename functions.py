@@ -1,8 +1,14 @@
+import json
 import os
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from datetime import datetime
 from datetime import timedelta
+from functools import partial
+from itertools import islice
+from multiprocessing import shared_memory
 from dateutil.relativedelta import relativedelta
 
 
@@ -28,419 +34,1344 @@ def same_day_date_range(str_date="2020-12-01"):
 # ========================================SEQUENCE==========================================
 
 
-def sequence_handler(dataframe, sequence_column, min_val, max_val):
-    data = dataframe[["createdDate", "fcnt", "sequence"]]
-    data["createdDate"] = pd.to_datetime(data["createdDate"])
-    data = data.sort_values("createdDate")
-
-    df = data.copy()
-    df = df.rename(columns={"createdDate": "Date"})
-
-    df["Stamp"] = "found"
-
-    # Identify duplicates only if they are next to each other
-    mask = df[sequence_column] == df[sequence_column].shift(-1)
-
-    # Keep the last occurrence
-    df = df[~mask | mask.shift(-1).fillna(False)]
+def _sequence_timeline(dates, fcnt, sequence, min_val, max_val, groups=None):
+    """
+    Vectorized core of sequence_handler. Rows must be sorted by group, then
+    by date; groups defaults to a single group. Returns a dict of arrays
+    with one row per expected sequence number: group, Date, sequence,
+    fcnt and Stamp.
+    """
+    sequence = np.asarray(sequence, dtype=np.int64)
+    fcnt = np.asarray(fcnt, dtype=float)
+    if groups is None:
+        groups = np.zeros(len(sequence), dtype=np.int64)
+
+    keep = _adjacent_keep(sequence, groups)
+    dates, fcnt, sequence, groups = dates[keep], fcnt[keep], sequence[keep], groups[keep]
+
+    if len(sequence) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return {
+            "group": empty,
+            "Date": dates,
+            "sequence": empty,
+            "fcnt": np.zeros(0),
+            "Stamp": np.zeros(0, dtype=object),
+        }
+
+    # A new subsequence starts with every group and whenever the sequence decreases
+    new_group = np.r_[True, groups[1:] != groups[:-1]]
+    segment_start = new_group | np.r_[False, sequence[1:] < sequence[:-1]]
+    segment = np.cumsum(segment_start) - 1
+    first_rows = np.flatnonzero(segment_start)
+    segment_group = groups[first_rows]
+    segment_min = np.minimum.reduceat(sequence, first_rows)
+    segment_max = np.maximum.reduceat(sequence, first_rows)
+
+    # The first subsequence of a group runs up to max_val, the last one starts
+    # at min_val and the ones in between cover the whole range
+    first_segment = np.r_[True, segment_group[1:] != segment_group[:-1]]
+    last_segment = np.r_[segment_group[1:] != segment_group[:-1], True]
+    low = np.where(first_segment, segment_min, min_val)
+    high = np.where(last_segment, segment_max, max_val)
+
+    # One cell per expected sequence number of every subsequence
+    width = np.maximum(high - low + 1, 0)
+    cell_start = np.cumsum(width) - width
+    in_range = (sequence >= low[segment]) & (sequence <= high[segment])
+    found_rows = np.flatnonzero(in_range)
+    found_cells = cell_start[segment[found_rows]] + sequence[found_rows] - low[segment[found_rows]]
+    missing_cells = np.flatnonzero(np.bincount(found_cells, minlength=width.sum()) == 0)
+
+    # Found rows keep their order inside a cell, missing cells get one empty row
+    cells = np.concatenate([found_cells, missing_cells])
+    source = np.concatenate([found_rows, np.full(len(missing_cells), -1)])
+    order = np.argsort(cells, kind="stable")
+    cells, source = cells[order], source[order]
+    is_found = source >= 0
+
+    out_segment = np.repeat(np.arange(len(width)), width)[cells]
+    out_sequence = low[out_segment] + cells - cell_start[out_segment]
+    out_group = segment_group[out_segment]
+    out_fcnt = np.where(is_found, fcnt[source], np.nan)
+
+    # Fill the dates of missing rows forwards, then backwards, per subsequence
+    out_dates = pd.Series(dates[source]).where(is_found)
+    out_dates = out_dates.groupby(out_segment).ffill().groupby(out_segment).bfill().to_numpy()
+
+    out_stamp = np.where(is_found, "found", None).astype(object)
+    _stamp_missing(out_stamp, out_group, out_sequence, out_fcnt)
+
+    return {
+        "group": out_group,
+        "Date": out_dates,
+        "sequence": out_sequence,
+        "fcnt": out_fcnt,
+        "Stamp": out_stamp,
+    }
 
-    # Container for subsequences dataframes
-    df_subsequences = []
 
-    # Picking the first row
-    df_current_subsequence = df.iloc[[0]]
+def _adjacent_keep(sequence, groups):
+    """
+    Rows kept after dropping duplicates that sit next to each other; like
+    the original shift based mask, this drops the second to last of every run.
+    """
+    if len(sequence) < 2:
+        return np.ones(len(sequence), dtype=bool)
+    same_next = np.r_[(sequence[1:] == sequence[:-1]) & (groups[1:] == groups[:-1]), False]
+    return ~same_next | np.r_[same_next[1:], False]
 
-    # Look through the second row till the end
-    for i in range(1, len(df)):
-        # if the current sequence number is lesser than the preceding,
-        if df[sequence_column].iloc[i] < df[sequence_column].iloc[i - 1]:
-            # Start a new subsequence when the sequence number decreases
-            df_subsequences.append(df_current_subsequence.copy())
 
-            # Start a new current subsequence with the current element
-            df_current_subsequence = df.iloc[[i]]
-        else:
-            # If the current element is not less than the precedent, append it to the current subsequence
-            df_current_subsequence = pd.concat([df_current_subsequence, df.iloc[[i]]])
+def _group_date_order(groups, dates):
+    """
+    Order that sorts rows by group, then by date; a no-op slice when they
+    already arrive sorted, as the (eui, createdDate) sorted cursors do.
+    """
+    same = groups[1:] == groups[:-1]
+    if np.all((groups[1:] > groups[:-1]) | (same & (dates[1:] >= dates[:-1]))):
+        return slice(None)
+    return np.lexsort((dates, groups))
 
-    # Adding the last subsequence to the list of subsequences
-    df_subsequences.append(df_current_subsequence.copy())
 
-    # Total subsequences in the df_subsequences
-    len_df_subsequences = len(df_subsequences)
+def _stamp_missing(stamp, groups, sequence, fcnt):
+    """
+    Stamp the empty rows of a timeline in place. Every gap between two rows
+    with an fcnt yields one stamp per missing number: "found" when the
+    sequence wrapped while fcnt went backwards (a device reset), "Unfound"
+    otherwise. Stamps fill the empty rows of their group in order.
+    """
+    rows = np.flatnonzero(~np.isnan(fcnt))
+    current, following = rows[:-1], rows[1:]
+    same_group = groups[current] == groups[following]
+    diff = sequence[following] - sequence[current]
+
+    # Wrapped gaps count the numbers up to 255 and from 0
+    gap = np.where(diff >= 1, diff - 1, 0)
+    gap = np.where(diff < 0, 255 - sequence[current] + sequence[following], gap)
+    gap = np.where(same_group, np.maximum(gap, 0), 0)
+    reset = (diff < 0) & (fcnt[current] > fcnt[following])
+    labels = np.repeat(np.where(reset, "found", "Unfound").astype(object), gap)
+    label_groups = np.repeat(groups[current], gap)
+
+    # Match the k-th stamp of a group with the k-th empty row of that group
+    empty = np.flatnonzero(pd.isnull(stamp))
+    empty_rank = _rank_in_group(groups[empty])
+    n_groups = int(groups.max()) + 1 if len(groups) else 0
+    label_start = np.r_[0, np.cumsum(np.bincount(label_groups, minlength=n_groups))]
+    label_count = np.diff(label_start)
+
+    empty_groups = groups[empty]
+    has_label = empty_rank < label_count[empty_groups]
+    stamp[empty[has_label]] = labels[label_start[empty_groups[has_label]] + empty_rank[has_label]]
+
+
+def _rank_in_group(groups):
+    """
+    Position of every element within its run of equal, sorted group ids.
+    """
+    if len(groups) == 0:
+        return np.zeros(0, dtype=np.int64)
+    run_start = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    run_length = np.diff(np.r_[run_start, len(groups)])
+    return np.arange(len(groups)) - np.repeat(run_start, run_length)
 
-    # If there are more than 2 subsequences,
-    if len_df_subsequences > 2:
-        # Isolate first and the last subsequences for special treatment
-        first_df_subsequences, last_df_subsequences = (
-            df_subsequences[0],
-            df_subsequences[-1],
-        )
 
-        # For the sequences in the middle, loop through the values and idx
-        for idx, sub in enumerate(df_subsequences[1:-1]):
-            # Create a DataFrame with all sequences from min_val to max_val
-            all_sequences = pd.DataFrame(
-                {sequence_column: np.arange(min_val, max_val + 1)}
-            )
+def sequence_handler(dataframe, sequence_column, min_val, max_val):
+    data = dataframe[["createdDate", "fcnt", sequence_column]].copy()
+    data["createdDate"] = pd.to_datetime(data["createdDate"])
+    data = data.sort_values("createdDate")
 
-            # Merge the original DataFrame with the DataFrame containing all sequences
-            merged_df = pd.merge(all_sequences, sub, on=sequence_column, how="left")
+    timeline = _sequence_timeline(
+        data["createdDate"].to_numpy(),
+        data["fcnt"].to_numpy(dtype=float),
+        data[sequence_column].to_numpy(),
+        min_val,
+        max_val,
+    )
 
-            # Mark the missing sequences as 'Unfound'
-            #             merged_df["Stamp"] = merged_df["Stamp"].fillna("Unfound")
+    merged = pd.DataFrame(
+        {
+            "Date": timeline["Date"],
+            sequence_column: timeline["sequence"],
+            "Stamp": timeline["Stamp"],
+        }
+    ).reset_index()
 
-            # Reorder columns if needed
-            merged_df = merged_df[["Date", sequence_column, "fcnt", "Stamp"]]
+    return merged[["index", "Date", sequence_column, "Stamp"]]
 
-            print("==============================================")
-            #             print("SUB-SEQUENCE # {}\n:{}".format(idx + 2, merged_df))
-            print("==============================================")
 
-            # Conver Date to datetime
-            merged_df["Date"] = pd.to_datetime(merged_df["Date"])
-            #             merged_df['Date'] = merged_df['Date'].interpolate()
+def sequence_runs(dataframe, sequence_column, min_val=0, max_val=255):
+    """
+    Missing sequence numbers as compact runs instead of one row per expected
+    number, so the output grows with the gaps and not with the window.
+    Every run has its first missing number (start_seq), its length, the
+    sequence_handler Stamp and the dates of the bracketing uplinks. after is
+    the position of the uplink the run follows among the date sorted,
+    de-duplicated uplinks; expand_sequence_runs uses it to rebuild the
+    sequence_handler output.
+    """
+    data = dataframe[["createdDate", "fcnt", sequence_column]].copy()
+    data["createdDate"] = pd.to_datetime(data["createdDate"])
+    data = data.sort_values("createdDate")
 
-            # Use ffill first to fill out null dates
-            merged_df["Date"] = merged_df["Date"].fillna(method="ffill")
+    sequence = data[sequence_column].to_numpy(dtype=np.int64)
+    keep = _adjacent_keep(sequence, np.zeros(len(sequence), dtype=np.int64))
+    sequence = sequence[keep]
+    dates = data["createdDate"].to_numpy()[keep]
+    fcnt = data["fcnt"].to_numpy(dtype=float)[keep]
 
-            # Use bill later to fill out the null dates
-            merged_df["Date"] = merged_df["Date"].fillna(method="bfill")
+    current, following = sequence[:-1], sequence[1:]
+    diff = following - current
+    wrapped = diff < 0
+    length = np.where(wrapped, max_val - current + following - min_val, np.maximum(diff - 1, 0))
+    reset = wrapped & (fcnt[:-1] > fcnt[1:])
+    after = np.flatnonzero(length > 0)
 
-            # Replace the corresponding dataframe
-            df_subsequences[idx + 1] = merged_df
+    return pd.DataFrame(
+        {
+            "start_seq": np.where(current == max_val, min_val, current + 1)[after],
+            "length": length[after],
+            "Stamp": np.where(reset, "found", "Unfound")[after],
+            "start_date": dates[:-1][after],
+            "end_date": dates[1:][after],
+            "wrapped": wrapped[after],
+            "after": after,
+        }
+    )
 
-        # For the first subsequence, create a dataframe with all numbers, starting from min of subsequence to max val.
-        all_sequences_for_first = pd.DataFrame(
-            {
-                sequence_column: np.arange(
-                    first_df_subsequences[sequence_column].min(), max_val + 1
-                )
-            }
-        )
-        # Do the merger of subsequence data and the one that was just created in the previous lines
-        merged_df_first = pd.merge(
-            all_sequences_for_first,
-            first_df_subsequences,
-            on=sequence_column,
-            how="left",
-        )
 
-        # Fill null values of Stamp with unfound
-        #         merged_df_first["Stamp"] = merged_df_first["Stamp"].fillna("Unfound")
+def expand_sequence_runs(runs, sequence_column, min_val=0, max_val=255, dataframe=None):
+    """
+    Expand sequence_runs back into one row per missing number, dated like
+    sequence_handler dates them. Given the dataframe the runs came from,
+    returns the full sequence_handler output instead.
+    """
+    length = runs["length"].to_numpy(dtype=np.int64)
+    start_seq = runs["start_seq"].to_numpy(dtype=np.int64)
+    wrapped = runs["wrapped"].to_numpy(dtype=bool)
+    run = np.repeat(np.arange(len(runs)), length)
+    step = _rank_in_group(run)
+
+    # Numbers before the wrap take the date of the uplink before the run,
+    # the ones after it the date of the uplink that ends the run
+    before_wrap = np.where(wrapped & (start_seq != min_val), max_val - start_seq + 1, length)
+    before_wrap = np.where(wrapped & (start_seq == min_val), 0, before_wrap)
+    span = max_val - min_val + 1
+    missing = pd.DataFrame(
+        {
+            "Date": np.where(
+                step < before_wrap[run],
+                runs["start_date"].to_numpy()[run],
+                runs["end_date"].to_numpy()[run],
+            ),
+            sequence_column: min_val + (start_seq[run] - min_val + step) % span,
+            "Stamp": runs["Stamp"].to_numpy(dtype=object)[run],
+        }
+    )
+    if dataframe is None:
+        return missing
 
-        # Set up columns
-        merged_df_first = merged_df_first[["Date", sequence_column, "fcnt", "Stamp"]]
+    data = dataframe[["createdDate", sequence_column]].copy()
+    data["createdDate"] = pd.to_datetime(data["createdDate"])
+    data = data.sort_values("createdDate")
+    sequence = data[sequence_column].to_numpy(dtype=np.int64)
+    keep = _adjacent_keep(sequence, np.zeros(len(sequence), dtype=np.int64))
+    received = pd.DataFrame(
+        {
+            "Date": data["createdDate"].to_numpy()[keep],
+            sequence_column: sequence[keep],
+            "Stamp": "found",
+        }
+    )
 
-        # change Date dtype
-        merged_df_first["Date"] = pd.to_datetime(merged_df_first["Date"])
+    # Every run sits right after the uplink it follows
+    position = np.r_[np.arange(len(received)), runs["after"].to_numpy(dtype=np.int64)[run]]
+    within = np.r_[np.zeros(len(received), dtype=np.int64), step + 1]
+    order = np.lexsort((within, position))
+    merged = pd.concat([received, missing], ignore_index=True).iloc[order].reset_index(drop=True)
 
-        #         merged_df_first['Date'] = merged_df_first['Date'].interpolate()
+    return merged.reset_index()[["index", "Date", sequence_column, "Stamp"]]
 
-        # Use ffill to fill out null dates
-        merged_df_first["Date"] = merged_df_first["Date"].fillna(method="ffill")
 
-        # Use bfill to fill out null dates
-        merged_df_first["Date"] = merged_df_first["Date"].fillna(method="bfill")
+def _timeline_shard(dates, fcnt, sequence, groups, min_val, max_val):
+    """
+    _sequence_timeline over one shard of EUIs, with group ids rebased to 0.
+    Runs in a worker process.
+    """
+    offset = groups[0] if len(groups) else 0
+    timeline = _sequence_timeline(dates, fcnt, sequence, min_val, max_val, groups - offset)
+    timeline["group"] = timeline["group"] + offset
+    return timeline
 
-        # Replace the corresponding subsequence
-        df_subsequences[0] = merged_df_first
 
-        # For the last subsequence, create a dataframe with all numbers, starting from min_val to the max of subsequence.
-        all_sequences_for_last = pd.DataFrame(
-            {
-                sequence_column: np.arange(
-                    min_val, last_df_subsequences[sequence_column].max() + 1
+def fleet_packet_loss(dataframe, min_val=0, max_val=255, workers=1, eui_column="eui"):
+    """
+    Packet loss of every EUI of a fleet in one grouped, vectorized pass.
+    dataframe holds eui, createdDate, fcnt and sequence for many sensors.
+    With workers > 1 and enough rows, EUI shards run on a process pool.
+    Returns (summary, timeline): summary has found, unfound and loss_ratio
+    per EUI; timeline is the sequence_handler output of every EUI with its
+    eui column.
+    """
+    data = dataframe[[eui_column, "createdDate", "fcnt", "sequence"]].copy()
+    data["createdDate"] = pd.to_datetime(data["createdDate"])
+    groups, euis = pd.factorize(data[eui_column], sort=True)
+
+    # Sort by EUI, then by date
+    order = _group_date_order(groups, data["createdDate"].to_numpy())
+    groups = groups[order]
+    dates = data["createdDate"].to_numpy()[order]
+    fcnt = data["fcnt"].to_numpy(dtype=float)[order]
+    sequence = data["sequence"].to_numpy(dtype=np.int64)[order]
+
+    if workers > 1 and len(data) >= PARALLEL_MIN_ROWS and len(euis) > 1:
+        # Contiguous shards of whole EUIs
+        bounds = np.searchsorted(groups, np.linspace(0, len(euis), workers + 1).astype(int))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    _timeline_shard,
+                    dates[start:stop],
+                    fcnt[start:stop],
+                    sequence[start:stop],
+                    groups[start:stop],
+                    min_val,
+                    max_val,
                 )
-            }
-        )
+                for start, stop in zip(bounds[:-1], bounds[1:])
+                if stop > start
+            ]
+            shards = [future.result() for future in futures]
+        timeline = {key: np.concatenate([shard[key] for shard in shards]) for key in shards[0]}
+    else:
+        timeline = _sequence_timeline(dates, fcnt, sequence, min_val, max_val, groups)
 
-        # Do the merger of subsequence data and the one that was just created in the previous lines
-        merged_df_last = pd.merge(
-            all_sequences_for_last, last_df_subsequences, on=sequence_column, how="left"
-        )
+    stamp = timeline["Stamp"]
+    found = np.bincount(timeline["group"], weights=stamp == "found", minlength=len(euis))
+    unfound = np.bincount(timeline["group"], weights=stamp == "Unfound", minlength=len(euis))
+    expected = found + unfound
+
+    summary = pd.DataFrame(
+        {
+            "eui": euis,
+            "found": found.astype(np.int64),
+            "unfound": unfound.astype(np.int64),
+            "loss_ratio": np.divide(unfound, expected, out=np.zeros(len(euis)), where=expected > 0),
+        }
+    )
+    timeline = pd.DataFrame(
+        {
+            "eui": pd.Categorical.from_codes(timeline["group"], categories=euis),
+            "Date": timeline["Date"],
+            "sequence": timeline["sequence"],
+            "Stamp": timeline["Stamp"],
+        }
+    )
 
-        # Fill null values of Stamp with unfound
-        #         merged_df_last["Stamp"] = merged_df_last["Stamp"].fillna("Unfound")
+    return summary, timeline
 
-        # Set up columns
-        merged_df_last = merged_df_last[["Date", sequence_column, "fcnt", "Stamp"]]
 
-        print("==============================================")
+def packet_loss_histogram(
+    dataframe, freq="1h", min_val=0, max_val=255, eui_column="eui", origin=None
+):
+    """
+    Expected, received and lost messages per EUI per fixed width time bin
+    (freq is anything pd.Timedelta accepts, such as "1h", "1D" or "15min").
+    Counts follow the sequence_handler stamps: received are the "found"
+    rows and lost the "Unfound" ones, each dated like sequence_handler
+    dates it. Bins start at origin, by default the first bin of the data.
+    Returns one row per EUI and bin, so pivoting loss_ratio gives a heatmap.
+    """
+    data = dataframe[[eui_column, "createdDate", "fcnt", "sequence"]].copy()
+    data["createdDate"] = pd.to_datetime(data["createdDate"])
+    groups, euis = pd.factorize(data[eui_column], sort=True)
+
+    order = _group_date_order(groups, data["createdDate"].to_numpy())
+    groups = groups[order]
+    dates = data["createdDate"].to_numpy().astype("datetime64[ns]").view(np.int64)[order]
+    fcnt = data["fcnt"].to_numpy(dtype=float)[order]
+    sequence = data["sequence"].to_numpy(dtype=np.int64)[order]
+    keep = _adjacent_keep(sequence, groups)
+    groups, dates, fcnt, sequence = groups[keep], dates[keep], fcnt[keep], sequence[keep]
+
+    # Integer bin of every uplink
+    width = pd.Timedelta(freq).value
+    if origin is None:
+        origin = dates.min() // width * width if len(dates) else 0
+    else:
+        origin = pd.Timestamp(origin).value
+    bins = (dates - origin) // width
+    n_bins = int(bins.max()) + 1 if len(bins) else 0
+    if len(bins) and bins.min() < 0:
+        raise ValueError("origin {} is after the first uplink".format(pd.Timestamp(origin)))
+
+    # Gaps between consecutive uplinks of an EUI, split at the wrap: numbers
+    # before it are dated with the uplink before the gap, the rest with the one after
+    cell = groups * n_bins + bins
+    n_cells = len(euis) * n_bins
+    step = sequence[1:] - sequence[:-1]
+    gap = np.flatnonzero((step != 1) & (step != 0) & (groups[1:] == groups[:-1]))
+    current, following = sequence[gap], sequence[gap + 1]
+    wrapped = following < current
+    before = np.where(wrapped, max_val - current, following - current - 1)
+    after = np.where(wrapped, following - min_val, 0)
+    reset = wrapped & (fcnt[gap] > fcnt[gap + 1])
+
+    received = np.bincount(cell, minlength=n_cells).astype(float)
+    lost = np.zeros(n_cells)
+    for counts, gap_cell in ((before, cell[gap]), (after, cell[gap + 1])):
+        received += np.bincount(gap_cell, weights=counts * reset, minlength=n_cells)
+        lost += np.bincount(gap_cell, weights=counts * ~reset, minlength=n_cells)
+    received = received.astype(np.int64)
+    lost = lost.astype(np.int64)
+    expected = received + lost
+
+    index = pd.MultiIndex.from_product(
+        [euis, pd.Timestamp(origin) + pd.Timedelta(width) * np.arange(n_bins)],
+        names=["eui", "bin"],
+    )
+    return pd.DataFrame(
+        {
+            "expected": expected,
+            "received": received,
+            "lost": lost,
+            "loss_ratio": np.divide(lost, expected, out=np.zeros(n_cells), where=expected > 0),
+        },
+        index=index,
+    )
 
-        # change Date dtype
-        merged_df_last["Date"] = pd.to_datetime(merged_df_last["Date"])
 
-        #         merged_df_last['Date'] = merged_df_last['Date'].interpolate()
+def _eui_to_json(eui):
+    """
+    An EUI as a JSON [type, value] pair, so tracker files give keys back
+    with their type: str, int or bytes (as hex).
+    """
+    if isinstance(eui, str):
+        return ["str", eui]
+    if isinstance(eui, (int, np.integer)):
+        return ["int", int(eui)]
+    if isinstance(eui, (bytes, bytearray)):
+        return ["bytes", bytes(eui).hex()]
+    raise TypeError("Cannot save an EUI of type {}".format(type(eui).__name__))
 
-        # Use ffill to fill out null dates
-        merged_df_last["Date"] = merged_df_last["Date"].fillna(method="ffill")
 
-        # Use bfill to fill out null dates
-        merged_df_last["Date"] = merged_df_last["Date"].fillna(method="bfill")
+def _eui_from_json(pair):
+    kind, value = pair
+    return bytes.fromhex(value) if kind == "bytes" else value
 
-        # Replace the corresponding subsequence
-        df_subsequences[-1] = merged_df_last
 
-    # If there are 2 subsequences,
-    elif len_df_subsequences == 2:
-        # Isolate first and the last subsequences for special treatment
-        first_df_subsequences, last_df_subsequences = (
-            df_subsequences[0],
-            df_subsequences[-1],
-        )
+class SequenceTracker:
+    """
+    Running per-EUI packet loss for streaming ingest, so a dashboard does not
+    have to refetch the window and rerun sequence_handler. Every EUI keeps
+    its last sequence, fcnt and date with found, unfound, duplicate and
+    reset counters. Gaps are counted like sequence_handler stamps them: the
+    0-255 wrap is followed, and a wrapped gap where fcnt went backwards (a
+    device reset) counts as found. Uplinks of an EUI must arrive in date
+    order.
+    """
 
-        # For the first subsequence, create a dataframe with all numbers, starting from min of subsequence to max val.
-        all_sequences_for_first = pd.DataFrame(
-            {
-                sequence_column: np.arange(
-                    first_df_subsequences[sequence_column].min(), max_val + 1
-                )
+    def __init__(self):
+        self._state = {}
+        self.found = 0
+        self.unfound = 0
+
+    def __len__(self):
+        return len(self._state)
+
+    def __contains__(self, eui):
+        return eui in self._state
+
+    def update(self, eui, sequence, fcnt, date=None):
+        """
+        Count one uplink.
+        """
+        # Plain Python numbers, stored like update_batch stores them
+        sequence = int(sequence)
+        fcnt = float(fcnt)
+        state = self._state.get(eui)
+        if state is None:
+            self._state[eui] = {
+                "sequence": sequence,
+                "fcnt": fcnt,
+                "date": date,
+                "found": 1,
+                "unfound": 0,
+                "duplicates": 0,
+                "resets": 0,
             }
-        )
+            self.found += 1
+            return
 
-        # Do the merger of subsequence data and the one that was just created in the previous lines
-        merged_df_first = pd.merge(
-            all_sequences_for_first,
-            first_df_subsequences,
-            on=sequence_column,
-            how="left",
+        diff = sequence - state["sequence"]
+        if diff == 0:
+            state["duplicates"] += 1
+        else:
+            found, unfound = 1, 0
+            if diff > 0:
+                unfound = diff - 1
+            elif fcnt < state["fcnt"]:
+                found += 255 - state["sequence"] + sequence
+                state["resets"] += 1
+            else:
+                unfound = 255 - state["sequence"] + sequence
+            state["found"] += found
+            state["unfound"] += unfound
+            self.found += found
+            self.unfound += unfound
+
+        state["sequence"] = sequence
+        state["fcnt"] = fcnt
+        state["date"] = date
+
+    def update_batch(self, dataframe, sequence_column="sequence", eui_column="eui"):
+        """
+        Count a DataFrame of uplinks with eui, createdDate, fcnt and the
+        sequence column, in one vectorized pass.
+        """
+        data = dataframe[[eui_column, "createdDate", "fcnt", sequence_column]].copy()
+        data["createdDate"] = pd.to_datetime(data["createdDate"])
+        groups, euis = pd.factorize(data[eui_column])
+        if len(euis) == 0:
+            return
+
+        order = _group_date_order(groups, data["createdDate"].to_numpy())
+        groups = groups[order]
+        dates = data["createdDate"].to_numpy()[order]
+        fcnt = data["fcnt"].to_numpy(dtype=float)[order]
+        sequence = data[sequence_column].to_numpy(dtype=np.int64)[order]
+
+        # The previous uplink of the first row of an EUI comes from the state
+        first = np.r_[True, groups[1:] != groups[:-1]]
+        known = np.array([eui in self._state for eui in euis])
+        prev_sequence = np.r_[0, sequence[:-1]]
+        prev_fcnt = np.r_[np.nan, fcnt[:-1]]
+        first_groups = groups[first]
+        prev_sequence[first] = [
+            self._state[euis[group]]["sequence"] if known[group] else 0 for group in first_groups
+        ]
+        prev_fcnt[first] = [
+            self._state[euis[group]]["fcnt"] if known[group] else np.nan for group in first_groups
+        ]
+        has_prev = ~first | known[groups]
+
+        diff = sequence - prev_sequence
+        duplicate = has_prev & (diff == 0)
+        wrapped = has_prev & (diff < 0)
+        reset = wrapped & (fcnt < prev_fcnt)
+        gap = np.where(wrapped, 255 - prev_sequence + sequence, np.maximum(diff - 1, 0))
+        found = np.where(duplicate, 0, 1 + np.where(reset, gap, 0))
+        unfound = np.where(has_prev & ~duplicate & ~reset, gap, 0)
+
+        n_groups = len(euis)
+        totals = {
+            "found": np.bincount(groups, weights=found, minlength=n_groups),
+            "unfound": np.bincount(groups, weights=unfound, minlength=n_groups),
+            "duplicates": np.bincount(groups, weights=duplicate, minlength=n_groups),
+            "resets": np.bincount(groups, weights=reset, minlength=n_groups),
+        }
+        last = np.r_[first[1:], True]
+        for group, row in zip(groups[last], np.flatnonzero(last)):
+            state = self._state.setdefault(
+                euis[group], {"found": 0, "unfound": 0, "duplicates": 0, "resets": 0}
+            )
+            for key, counts in totals.items():
+                state[key] += int(counts[group])
+            state["sequence"] = int(sequence[row])
+            state["fcnt"] = float(fcnt[row])
+            state["date"] = pd.Timestamp(dates[row])
+
+        self.found += int(totals["found"].sum())
+        self.unfound += int(totals["unfound"].sum())
+
+    def stats(self, eui=None):
+        """
+        Current loss counters of one EUI, or of the whole fleet.
+        """
+        if eui is None:
+            found, unfound = self.found, self.unfound
+            stats = {"euis": len(self._state)}
+        else:
+            state = self._state[eui]
+            found, unfound = state["found"], state["unfound"]
+            stats = dict(state)
+        expected = found + unfound
+        stats.update(
+            found=found,
+            unfound=unfound,
+            loss_ratio=unfound / expected if expected else 0.0,
         )
+        return stats
+
+    def summary(self):
+        """
+        Counters of every EUI as a DataFrame shaped like the fleet_packet_loss summary.
+        """
+        summary = pd.DataFrame.from_dict(self._state, orient="index")
+        if summary.empty:
+            return pd.DataFrame(columns=["eui", "found", "unfound", "loss_ratio"])
+        expected = summary["found"] + summary["unfound"]
+        summary["loss_ratio"] = (summary["unfound"] / expected.where(expected > 0)).fillna(0.0)
+        return summary.rename_axis("eui").reset_index()
+
+    def save(self, path):
+        """
+        Write the state to a JSON file.
+        """
+        state = [
+            [
+                _eui_to_json(eui),
+                dict(values, date=None if values["date"] is None else str(values["date"])),
+            ]
+            for eui, values in self._state.items()
+        ]
+        with open(path, "w") as file:
+            json.dump({"found": self.found, "unfound": self.unfound, "euis": state}, file)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Rebuild a tracker from a file written by save.
+        """
+        with open(path) as file:
+            saved = json.load(file)
+        tracker = cls()
+        tracker.found = saved["found"]
+        tracker.unfound = saved["unfound"]
+        for eui, values in saved["euis"]:
+            if values["date"] is not None:
+                values["date"] = pd.Timestamp(values["date"])
+            tracker._state[_eui_from_json(eui)] = values
+        return tracker
 
-        # Fill null values of Stamp with unfound
-        #         merged_df_first["Stamp"] = merged_df_first["Stamp"].fillna("Unfound")
-
-        # Set up columns
-        merged_df_first = merged_df_first[["Date", sequence_column, "fcnt", "Stamp"]]
-
-        # Convert Date to datetime
-        merged_df_first["Date"] = pd.to_datetime(merged_df_first["Date"])
-
-        # Use ffill to fill out null dates
-        merged_df_first["Date"] = merged_df_first["Date"].fillna(method="ffill")
-
-        # Use bfill to fill out null dates
-        merged_df_first["Date"] = merged_df_first["Date"].fillna(method="bfill")
-
-        #         merged_df_first['Date'] = merged_df_first['Date'].interpolate()
 
-        # Replace with corresponding subsequence
-        df_subsequences[0] = merged_df_first
+# ========================================OCCUPANCY==========================================
 
-        # For the last subsequence, create a dataframe with all numbers, starting from min_val to max of subsequence.
-        all_sequences_for_last = pd.DataFrame(
-            {
-                sequence_column: np.arange(
-                    min_val, last_df_subsequences[sequence_column].max() + 1
-                )
-            }
-        )
+# Occupied status label the occupancy functions look for by default, as status() labels
+# uplinks; frames decoded by decode_payloads use OCCUPANCY_LABELS[1] instead
+OCCUPIED_STATUS = "occupied"
 
-        # Do the merger of subsequence data and the one that was just created in the previous lines
-        merged_df_last = pd.merge(
-            all_sequences_for_last, last_df_subsequences, on=sequence_column, how="left"
-        )
 
-        # Fill null values of Stamp with unfound
-        #         merged_df_last["Stamp"] = merged_df_last["Stamp"].fillna("Unfound")
+def _occupancy_sessions(dates, occupied, now, groups=None):
+    """
+    Vectorized core of occupancy_sessions. Rows must be sorted by group,
+    then by date; groups defaults to a single group. A session starts with
+    an occupied event that follows a free one (or opens the group) and ends
+    with the next event that is not occupied; sessions still occupied at the
+    end of their group stay open until now. Returns a dict of arrays: group,
+    start, end, duration_minutes and open.
+    """
+    occupied = np.asarray(occupied, dtype=bool)
+    if groups is None:
+        groups = np.zeros(len(occupied), dtype=np.int64)
+
+    new_group = np.r_[True, groups[1:] != groups[:-1]]
+    previous = np.r_[False, occupied[:-1]] & ~new_group
+    starts = np.flatnonzero(occupied & ~previous)
+    ends = np.flatnonzero(~occupied & previous)
+
+    # Starts and ends alternate inside a group, so the end of a session is
+    # the first end after its start, if that end belongs to the same group
+    match = np.searchsorted(ends, starts)
+    closed = match < len(ends)
+    closed[closed] = groups[ends[match[closed]]] == groups[starts[closed]]
+
+    start_dates = dates[starts]
+    end_dates = np.full(len(starts), np.datetime64(now), dtype=dates.dtype)
+    end_dates[closed] = dates[ends[match[closed]]]
+
+    return {
+        "group": groups[starts],
+        "start": start_dates,
+        "end": end_dates,
+        "duration_minutes": (end_dates - start_dates) / np.timedelta64(1, "m"),
+        "open": ~closed,
+    }
 
-        # Setup columns
-        merged_df_last = merged_df_last[["Date", sequence_column, "fcnt", "Stamp"]]
-        print("==============================================")
 
-        # Convert Date to datetime
-        merged_df_last["Date"] = pd.to_datetime(merged_df_last["Date"])
-        #         merged_df_last['Date'] = merged_df_last['Date'].interpolate()
+def _naive_utc(dates):
+    """
+    Datetime Series as naive UTC; naive dates are taken to be UTC already.
+    """
+    dates = pd.to_datetime(dates)
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_convert("UTC").dt.tz_localize(None)
+    return dates
 
-        # Use ffill to fill out null dates
-        merged_df_last["Date"] = merged_df_last["Date"].fillna(method="ffill")
 
-        # Use bfill to fill out null dates
-        merged_df_last["Date"] = merged_df_last["Date"].fillna(method="bfill")
+def _naive_utc_timestamp(value=None):
+    """
+    Timestamp as naive UTC, the current time when value is None.
+    """
+    value = pd.Timestamp.now(tz="UTC") if value is None else pd.Timestamp(value)
+    if value.tz is not None:
+        value = value.tz_convert("UTC").tz_localize(None)
+    return value
 
-        # Replace with corresponding subsequence
-        df_subsequences[-1] = merged_df_last
 
-    # If there is only 1 subsequences,
-    elif len_df_subsequences == 1:
-        # Isolate it
-        only_df_subsequences = df_subsequences[0]
+def occupancy_sessions(
+    dataframe, now=None, status_column="occupancy_status", occupied=OCCUPIED_STATUS
+):
+    """
+    Occupancy sessions of one sensor as a DataFrame of start, end,
+    duration_minutes and open. Open sessions end at now, which defaults to
+    the current time. The input DataFrame is left untouched.
+    """
+    dates = _naive_utc(dataframe["createdDate"]).to_numpy()
+    order = np.argsort(dates, kind="stable")
 
-        # For this only subsequence, create a dataframe with all numbers, starting from min of subsequence to max of the subsequence.
-        all_sequences_for_only = pd.DataFrame(
-            {
-                sequence_column: np.arange(
-                    only_df_subsequences[sequence_column].min(),
-                    only_df_subsequences[sequence_column].max() + 1,
-                )
-            }
-        )
+    sessions = _occupancy_sessions(
+        dates[order],
+        (dataframe[status_column] == occupied).to_numpy()[order],
+        _naive_utc_timestamp(now).to_datetime64(),
+    )
+    del sessions["group"]
 
-        # Do the merger of subsequence data and the one that was just created in the previous lines
-        merged_df_only = pd.merge(
-            all_sequences_for_only, only_df_subsequences, on=sequence_column, how="left"
-        )
+    return pd.DataFrame(sessions)
 
-        # Fill null values of Stamp with unfound
-        #         merged_df_only["Stamp"] = merged_df_only["Stamp"].fillna("Unfound")
 
-        # Set up columns
-        merged_df_only = merged_df_only[["Date", sequence_column, "fcnt", "Stamp"]]
-        print("==============================================")
-        # print(merged_df_only)
+def fleet_occupancy_sessions(
+    dataframe,
+    now=None,
+    status_column="occupancy_status",
+    occupied=OCCUPIED_STATUS,
+    eui_column="eui",
+):
+    """
+    Occupancy sessions of every EUI in one grouped pass, as occupancy_sessions
+    returns them with an eui column in front.
+    """
+    dates = _naive_utc(dataframe["createdDate"]).to_numpy()
+    groups, euis = pd.factorize(dataframe[eui_column], sort=True)
+    order = _group_date_order(groups, dates)
+
+    sessions = _occupancy_sessions(
+        dates[order],
+        (dataframe[status_column] == occupied).to_numpy()[order],
+        _naive_utc_timestamp(now).to_datetime64(),
+        groups[order],
+    )
+    sessions["group"] = pd.Categorical.from_codes(sessions["group"], categories=euis)
 
-        # Convert Date to datetime
-        merged_df_only["Date"] = pd.to_datetime(merged_df_only["Date"])
+    return pd.DataFrame(sessions).rename(columns={"group": "eui"})
 
-        # Use ffill to fill out null dates
-        merged_df_only["Date"] = merged_df_only["Date"].fillna(method="ffill")
 
-        # Use bfill to fill out null dates
-        merged_df_only["Date"] = merged_df_only["Date"].fillna(method="bfill")
+def _group_percentiles(groups, values, n_groups, percentiles):
+    """
+    Linearly interpolated percentiles of values per group id, NaN for
+    empty groups. Returns an array of shape (n_groups, len(percentiles)).
+    """
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    offsets = np.cumsum(counts) - counts
+
+    result = np.full((n_groups, len(percentiles)), np.nan)
+    has_values = counts > 0
+    for column, percentile in enumerate(percentiles):
+        position = offsets + (counts - 1) * percentile / 100
+        low = np.floor(position).astype(np.int64)[has_values]
+        high = np.ceil(position).astype(np.int64)[has_values]
+        fraction = position[has_values] - low
+        result[has_values, column] = values[low] + (values[high] - values[low]) * fraction
+    return result
+
+
+def occupancy_metrics(sessions, start=None, end=None, percentiles=(50, 90, 95)):
+    """
+    Bay utilization metrics from fleet_occupancy_sessions over the window
+    [start, end], by default from the first session start to the last
+    session end, so open sessions bound it at the now they were built with.
+    Sessions are clipped to the window. Returns (metrics, peak): metrics has
+    per EUI the utilization (occupied fraction of the window), turnover
+    (sessions started per day), the dwell time percentiles of closed
+    sessions in minutes and the number of sessions started; peak holds the largest
+    number of bays occupied at once and when it was first reached.
+    """
+    starts = sessions["start"].to_numpy(dtype="datetime64[ns]")
+    ends = sessions["end"].to_numpy(dtype="datetime64[ns]")
+    eui = pd.Categorical(sessions["eui"])
+    groups = eui.codes.astype(np.int64)
+    n_groups = len(eui.categories)
+
+    start = None if start is None else _naive_utc_timestamp(start).to_datetime64()
+    end = None if end is None else _naive_utc_timestamp(end).to_datetime64()
+    if len(starts):
+        start = starts.min() if start is None else start
+        end = ends.max() if end is None else end
+    # Without sessions a missing bound takes the other one, an empty window
+    start = end if start is None else start
+    end = start if end is None else end
+    if start is None:
+        start = end = np.datetime64("NaT", "ns")
+    window_minutes = (end - start) / np.timedelta64(1, "m")
+
+    clipped = np.maximum(np.minimum(ends, end) - np.maximum(starts, start), np.timedelta64(0))
+    occupied = np.bincount(groups, weights=clipped / np.timedelta64(1, "m"), minlength=n_groups)
+    started = (starts >= start) & (starts <= end)
+    turnover = np.bincount(groups, weights=started, minlength=n_groups)
+
+    closed = ~sessions["open"].to_numpy(dtype=bool)
+    durations = sessions["duration_minutes"].to_numpy(dtype=float)
+    dwell = _group_percentiles(groups[closed], durations[closed], n_groups, percentiles)
+
+    window_days = window_minutes / 1440
+    metrics = pd.DataFrame(
+        {
+            "eui": eui.categories,
+            "sessions": turnover.astype(np.int64),
+            "occupied_minutes": occupied,
+            "utilization": occupied / window_minutes if window_minutes > 0 else np.nan,
+            "turnover_per_day": turnover / window_days if window_minutes > 0 else np.nan,
+        }
+    )
+    for column, percentile in enumerate(percentiles):
+        metrics["dwell_p{}".format(percentile)] = dwell[:, column]
+
+    # Sweep over session edges inside the window; at equal times ends go first
+    inside = np.flatnonzero(clipped > np.timedelta64(0))
+    edges = np.r_[np.maximum(starts[inside], start), np.minimum(ends[inside], end)]
+    steps = np.r_[np.ones(len(inside), dtype=np.int64), -np.ones(len(inside), dtype=np.int64)]
+    order = np.lexsort((steps, edges))
+    concurrent = np.cumsum(steps[order])
+    if len(concurrent):
+        busiest = int(np.argmax(concurrent))
+        peak = {
+            "peak_concurrent": int(concurrent[busiest]),
+            "at": pd.Timestamp(edges[order][busiest]),
+        }
+    else:
+        peak = {"peak_concurrent": 0, "at": pd.NaT}
 
-        #         merged_df_only['Date'] = merged_df_only['Date'].interpolate()
+    return metrics, peak
 
-        # Replace with corresponding subsequence
-        df_subsequences[0] = merged_df_only
 
-    # Concatenate the reulsts
-    df_sequence = pd.concat(df_subsequences, ignore_index=True).reset_index()
+class OccupancyTracker:
+    """
+    Streaming occupancy sessionizer for daily jobs that only see new
+    uplinks. Every EUI keeps the start of its open session and its last
+    event date across batches; closed sessions are emitted as they end, so
+    sessions crossing a batch edge come out once and whole. Frames are read
+    like occupancy_sessions reads them, rows without a status are skipped
+    and uplinks of an EUI must arrive in date order.
+    """
 
-    difference = []
+    def __init__(self, status_column="occupancy_status", occupied=OCCUPIED_STATUS):
+        self.status_column = status_column
+        self.occupied = occupied
+        self._state = {}
+
+    def __len__(self):
+        return len(self._state)
+
+    def update(self, eui, date, status):
+        """
+        Feed one frame; returns the session it closes as a dict, or None.
+        """
+        if pd.isnull(status):
+            return None
+        date = _naive_utc_timestamp(date)
+        state = self._state.setdefault(eui, {"open_since": None, "last_date": None})
+        state["last_date"] = date
+        if status == self.occupied:
+            if state["open_since"] is None:
+                state["open_since"] = date
+            return None
+        if state["open_since"] is None:
+            return None
+
+        start, state["open_since"] = state["open_since"], None
+        return {
+            "eui": eui,
+            "start": start,
+            "end": date,
+            "duration_minutes": (date - start) / pd.Timedelta(minutes=1),
+        }
+
+    def update_batch(self, dataframe, eui_column="eui"):
+        """
+        Feed a DataFrame of frames with eui, createdDate and the status
+        column in one vectorized pass. Returns the sessions it closes as a
+        DataFrame of eui, start, end and duration_minutes.
+        """
+        data = dataframe[dataframe[self.status_column].notna()]
+        euis = pd.unique(data[eui_column])
+        groups = pd.Index(euis).get_indexer(data[eui_column])
+        dates = _naive_utc(data["createdDate"]).to_numpy(dtype="datetime64[ns]")
+        occupied = (data[self.status_column] == self.occupied).to_numpy()
+
+        # Open sessions re-enter as an occupied event at their start
+        carried = [
+            (group, self._state[eui]["open_since"])
+            for group, eui in enumerate(euis)
+            if eui in self._state and self._state[eui]["open_since"] is not None
+        ]
+        if carried:
+            carried_groups, carried_dates = zip(*carried)
+            groups = np.r_[np.array(carried_groups, dtype=np.int64), groups]
+            dates = np.r_[np.array(carried_dates, dtype="datetime64[ns]"), dates]
+            occupied = np.r_[np.ones(len(carried), dtype=bool), occupied]
+
+        order = np.lexsort((dates, groups))
+        groups, dates, occupied = groups[order], dates[order], occupied[order]
+        sessions = _occupancy_sessions(dates, occupied, np.datetime64("NaT"), groups)
+
+        last = np.r_[groups[1:] != groups[:-1], True] if len(groups) else np.zeros(0, dtype=bool)
+        still_open = sessions["open"]
+        open_since = dict(zip(sessions["group"][still_open], sessions["start"][still_open]))
+        for group, date in zip(groups[last], dates[last]):
+            start = open_since.get(group)
+            self._state[euis[group]] = {
+                "open_since": None if start is None else pd.Timestamp(start),
+                "last_date": pd.Timestamp(date),
+            }
 
-    find_diff_df = df_sequence.dropna(subset=["fcnt"])
+        closed = ~sessions["open"]
+        return pd.DataFrame(
+            {
+                "eui": euis[sessions["group"][closed]],
+                "start": sessions["start"][closed],
+                "end": sessions["end"][closed],
+                "duration_minutes": sessions["duration_minutes"][closed],
+            }
+        )
 
-    seq_list_diff = find_diff_df["sequence"].to_list()
+    def open_sessions(self, now=None):
+        """
+        Sessions still open, with their duration up to now (the current time by default).
+        """
+        now = _naive_utc_timestamp(now)
+        rows = [
+            (eui, state["open_since"])
+            for eui, state in self._state.items()
+            if state["open_since"] is not None
+        ]
+        sessions = pd.DataFrame(rows, columns=["eui", "start"])
+        sessions["start"] = pd.to_datetime(sessions["start"])
+        sessions["end"] = now
+        sessions["duration_minutes"] = (now - sessions["start"]) / pd.Timedelta(minutes=1)
+        return sessions
+
+    def save(self, path):
+        """
+        Write the state to a JSON file.
+        """
+        state = [
+            [
+                _eui_to_json(eui),
+                {key: None if value is None else str(value) for key, value in values.items()},
+            ]
+            for eui, values in self._state.items()
+        ]
+        with open(path, "w") as file:
+            json.dump(
+                {"status_column": self.status_column, "occupied": self.occupied, "euis": state},
+                file,
+            )
 
-    for i in range(len(seq_list_diff) - 1):
-        current_seq = seq_list_diff[i]
-        next_seq = seq_list_diff[i + 1]
-        diff = next_seq - current_seq
+    @classmethod
+    def load(cls, path):
+        """
+        Rebuild a tracker from a file written by save.
+        """
+        with open(path) as file:
+            saved = json.load(file)
+        tracker = cls(saved["status_column"], saved["occupied"])
+        for eui, values in saved["euis"]:
+            tracker._state[_eui_from_json(eui)] = {
+                key: None if value is None else pd.Timestamp(value) for key, value in values.items()
+            }
+        return tracker
 
-        if diff == 1:
-            difference.append(0)
-        elif diff == 2:
-            difference.append(1)
-        elif diff > 1:
-            difference.append(diff - 1)
-        elif diff == 0:
-            difference.append(diff)
-        elif diff < 0:
-            val_1 = 255 - current_seq
-            val_2 = next_seq
-            diff = val_1 + val_2
-            difference.append(diff)
 
-    placeholder_value = 0
-    if len(difference) < len(find_diff_df):
-        difference.append(placeholder_value)
+def _gallop(keys, key, side="left"):
+    """
+    np.searchsorted(keys, key, side) found by galloping from the front, so
+    it costs O(log p) for an answer p instead of O(log len(keys)).
+    """
+    bound = 1
+    while bound < len(keys):
+        before = keys[bound - 1] <= key if side == "right" else keys[bound - 1] < key
+        if not before:
+            break
+        bound *= 2
+    low = bound // 2
+    return low + int(np.searchsorted(keys[low : min(bound, len(keys))], key, side=side))
 
-    find_diff_df["difference_column"] = difference
-    merged = pd.merge(
-        df_sequence,
-        find_diff_df[["difference_column"]],
-        left_index=True,
-        right_index=True,
-        how="left",
-    )
 
-    merged["difference_column"] = merged["difference_column"].where(
-        merged["difference_column"].notnull(), None
-    )
+class SessionIndex:
+    """
+    Static centered interval tree over occupancy sessions (eui, start, end),
+    each taken as the half-open interval [start, end). A stab walks one root
+    to leaf path of O(log n) nodes and gallops to the end of the matching
+    prefix of every node, so it finds its k sessions in O(log n + k). An
+    overlap is the stab at its start plus the sessions starting inside the
+    window, a range of the sorted starts, so it is O(log n + k) as well.
+    Hits come back in session order. Only leaves of at most LEAF_SIZE
+    sessions are scanned: sessions sharing their bounds are split around a
+    center like any others. Bulk concurrency counts come from two
+    searchsorted calls over the sorted starts and ends.
+    """
 
-    stamp_df = merged.dropna(subset=["fcnt"])
+    # Nodes with at most this many sessions are scanned instead of split
+    LEAF_SIZE = 64
+
+    def __init__(self, sessions):
+        self.sessions = sessions.reset_index(drop=True)
+        self._starts = self.sessions["start"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+        self._ends = self.sessions["end"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+        self._start_order = np.argsort(self._starts, kind="stable")
+        self._sorted_starts = self._starts[self._start_order]
+        self._sorted_ends = np.sort(self._ends)
+
+        # Every node is (center, members, left, right); leaves have no center.
+        # Sessions without length hold no stab, overlaps find them by start
+        self._nodes = []
+        self._root = self._build(np.flatnonzero(self._ends > self._starts))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _build(self, members):
+        if len(members) == 0:
+            return -1
+        starts, ends = self._starts[members], self._ends[members]
+        if len(members) <= self.LEAF_SIZE:
+            self._nodes.append((None, members, -1, -1))
+            return len(self._nodes) - 1
+
+        # A middle endpoint, kept int64 so nanosecond times compare exactly
+        endpoints = np.r_[starts, ends]
+        center = int(np.partition(endpoints, len(members))[len(members)])
+        if not ((starts <= center) & (ends > center)).any() and (ends <= center).all():
+            # Every session ends by the center, such as many sessions sharing
+            # their end: the middle start is inside its own session instead
+            center = int(np.partition(starts, len(starts) // 2)[len(starts) // 2])
+        here = (starts <= center) & (ends > center)
+        left, right = members[ends <= center], members[starts > center]
+
+        # Members sorted by start, and by end from the latest down, with
+        # their keys so queries never gather them
+        here = members[here]
+        by_start = here[np.argsort(self._starts[here], kind="stable")]
+        by_end = here[np.argsort(-self._ends[here], kind="stable")]
+        members = (by_start, self._starts[by_start], by_end, -self._ends[by_end])
+        node = len(self._nodes)
+        self._nodes.append(None)
+        self._nodes[node] = (center, members, self._build(left), self._build(right))
+        return node
+
+    def _stab(self, time):
+        """
+        Positions of the sessions with start <= time < end.
+        """
+        found = []
+        node = self._root
+        while node >= 0:
+            center, members, left, right = self._nodes[node]
+            if center is None:
+                inside = (self._starts[members] <= time) & (self._ends[members] > time)
+                found.append(members[inside])
+                break
+
+            by_start, start_keys, by_end, end_keys = members
+            if time < center:
+                # Every member ends after time; keep those starting by time
+                found.append(by_start[: _gallop(start_keys, time, side="right")])
+                node = left
+            else:
+                # Every member starts by time; keep those ending after it
+                found.append(by_end[: _gallop(end_keys, -time, side="left")])
+                node = right
+
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(found)
+
+    def _query(self, low, high):
+        """
+        Positions of the sessions with start < high and end > low.
+        """
+        stabbed = self._stab(low)
+        stabbed = stabbed[self._starts[stabbed] < high]
+        first = np.searchsorted(self._sorted_starts, low, side="right")
+        last = np.searchsorted(self._sorted_starts, high, side="left")
+        inside = self._start_order[first : max(last, first)]
+        return np.sort(np.concatenate([stabbed, inside]))
+
+    def stab(self, time):
+        """
+        Sessions in progress at time.
+        """
+        time = _naive_utc_timestamp(time).value
+        return self.sessions.iloc[np.sort(self._stab(time))]
+
+    def overlap(self, start, end):
+        """
+        Sessions overlapping the window [start, end).
+        """
+        start = _naive_utc_timestamp(start).value
+        end = _naive_utc_timestamp(end).value
+        return self.sessions.iloc[self._query(start, end)]
+
+    def concurrency(self, times):
+        """
+        Number of sessions in progress at every one of times, for example
+        every minute of a day from pd.date_range.
+        """
+        times = pd.DatetimeIndex(_naive_utc(pd.Series(pd.to_datetime(times))))
+        values = times.to_numpy(dtype="datetime64[ns]").view(np.int64)
+        counts = np.searchsorted(self._sorted_starts, values, side="right") - np.searchsorted(
+            self._sorted_ends, values, side="right"
+        )
+        return pd.Series(counts, index=times, name="concurrent")
 
-    seq = stamp_df["sequence"].to_list()
-    fcnt_lis = stamp_df["fcnt"].to_list()
-    difference = stamp_df["difference_column"].to_list()
 
-    my_list = []
-    for i in range(len(difference) - 1):
-        current_seq = seq[i]
-        next_seq = seq[i + 1]
-        diff = next_seq - current_seq
+class OccupancyCube:
+    """
+    Occupied minutes per (day, eui, hour) in a float32 file mapped with
+    np.memmap, next to a JSON sidecar (path + ".json") with the first day
+    and the EUI order. Days are the outer axis, so appending days only
+    extends the file; a new EUI rewrites it. Queries slice the mapped array
+    and never touch Mongo.
+    """
 
-        if difference[i] >= 1:
-            if diff < 0:
-                if fcnt_lis[i] > fcnt_lis[i + 1]:
-                    my_list.extend(["found"] * int(difference[i]))
-                else:
-                    my_list.extend(["Unfound"] * int(difference[i]))
-            else:
-                my_list.extend(["Unfound"] * int(difference[i]))
+    def __init__(self, path, mode="r"):
+        with open(path + ".json") as file:
+            meta = json.load(file)
+        self.path = path
+        self.mode = mode
+        self.first_day = pd.Timestamp(meta["first_day"])
+        self.euis = list(meta["euis"])
+        self._eui_ids = {eui: position for position, eui in enumerate(self.euis)}
+        self._days = meta["days"]
+        self._map()
+
+    @classmethod
+    def create(cls, path, first_day, euis=()):
+        """
+        Start an empty cube whose first day is first_day and open it for writing.
+        """
+        open(path, "wb").close()
+        meta = {
+            "first_day": str(pd.Timestamp(first_day).normalize().date()),
+            "euis": list(euis),
+            "days": 0,
+        }
+        with open(path + ".json", "w") as file:
+            json.dump(meta, file)
+        return cls(path, mode="r+")
+
+    def _map(self):
+        shape = (self._days, len(self.euis), 24)
+        if self._days and self.euis:
+            self.array = np.memmap(self.path, dtype=np.float32, mode=self.mode, shape=shape)
+        else:
+            self.array = np.zeros(shape, dtype=np.float32)
+
+    def _save_meta(self):
+        meta = {"first_day": str(self.first_day.date()), "euis": self.euis, "days": self._days}
+        with open(self.path + ".json", "w") as file:
+            json.dump(meta, file)
+
+    def _grow(self, days, euis):
+        """
+        Make room for days days and the new euis.
+        """
+        if self.mode == "r":
+            raise ValueError("cube {} is open read only".format(self.path))
+        new_euis = [eui for eui in dict.fromkeys(euis) if eui not in self._eui_ids]
+        days = max(days, self._days)
+        if days == self._days and not new_euis:
+            return
+
+        if isinstance(self.array, np.memmap):
+            self.array.flush()
+        old = self.array
+        n_euis = len(self.euis) + len(new_euis)
+        if new_euis and self._days and self.euis:
+            # The EUI axis is inside every day, so the file is rewritten day by day
+            old = np.array(old)
+        else:
+            old = None
+        with open(self.path, "r+b") as file:
+            file.truncate(days * n_euis * 24 * 4)
+
+        self.euis.extend(new_euis)
+        self._eui_ids = {eui: position for position, eui in enumerate(self.euis)}
+        self._days = days
+        self._map()
+        if old is not None:
+            self.array[: old.shape[0], : old.shape[1]] = old
+            self.array[: old.shape[0], old.shape[1] :] = 0
+        self._save_meta()
+
+    def add_sessions(self, sessions):
+        """
+        Add the minutes of occupancy sessions (eui, start, end), split over
+        the hours they cover. Time before first_day is ignored. Feed every
+        session once, typically the closed sessions of completed days.
+        """
+        hour = 3600 * 10**9
+        origin = self.first_day.value
+        starts = sessions["start"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+        starts = np.maximum(starts, origin)
+        ends = sessions["end"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+        euis = np.asarray(sessions["eui"], dtype=object)[keep]
+        if len(starts) == 0:
+            return
+
+        # One piece per session and hour it covers
+        first_hour = (starts - origin) // hour
+        count = (ends - 1 - origin) // hour - first_hour + 1
+        piece = np.repeat(np.arange(len(starts)), count)
+        hours = first_hour[piece] + _rank_in_group(piece)
+        minutes = (
+            np.minimum(ends[piece], origin + (hours + 1) * hour)
+            - np.maximum(starts[piece], origin + hours * hour)
+        ) / (60 * 10**9)
+
+        self._grow(int(hours.max()) // 24 + 1, euis)
+        eui_ids = np.array([self._eui_ids[eui] for eui in euis], dtype=np.int64)[piece]
+        days = hours // 24
+        first_day = int(days.min())
+        n_days = int(days.max()) - first_day + 1
+        cells = ((days - first_day) * len(self.euis) + eui_ids) * 24 + hours % 24
+        totals = np.bincount(cells, weights=minutes, minlength=n_days * len(self.euis) * 24)
+        totals = totals.reshape(n_days, len(self.euis), 24).astype(np.float32)
+        self.array[first_day : first_day + n_days] += totals
+
+    def flush(self):
+        if isinstance(self.array, np.memmap):
+            self.array.flush()
+
+    @property
+    def days(self):
+        return pd.date_range(self.first_day, periods=self._days, freq="D")
+
+    def _day_slice(self, start=None, end=None):
+        begin, stop = 0, self._days
+        if start is not None:
+            begin = (pd.Timestamp(start).normalize() - self.first_day).days
+        if end is not None:
+            stop = (pd.Timestamp(end).normalize() - self.first_day).days + 1
+        return slice(max(begin, 0), max(min(stop, self._days), 0))
+
+    def select(self, euis=None, start=None, end=None, hours=None):
+        """
+        Occupied minutes of the days from start to end (inclusive), for a
+        group of EUIs and hours of the day, shaped (day, eui, hour).
+        """
+        cube = self.array[self._day_slice(start, end)]
+        if euis is not None:
+            cube = cube[:, [self._eui_ids[eui] for eui in euis]]
+        if hours is not None:
+            cube = cube[:, :, hours]
+        return cube
+
+    def occupied_minutes(self, euis=None, start=None, end=None, hours=None, by="eui"):
+        """
+        Sum of select over everything but the by axis ("eui", "day" or
+        "hour"), as a Series; by=None sums everything to one number.
+        """
+        cube = self.select(euis, start, end, hours)
+        if by is None:
+            return float(cube.sum(dtype=np.float64))
+        if by == "eui":
+            labels = self.euis if euis is None else list(euis)
+            index = pd.Index(labels, name="eui")
+            return pd.Series(cube.sum(axis=(0, 2), dtype=np.float64), index=index)
+        if by == "day":
+            labels = self.days[self._day_slice(start, end)]
+            return pd.Series(cube.sum(axis=(1, 2), dtype=np.float64), index=labels.rename("day"))
+        if by == "hour":
+            labels = np.arange(24) if hours is None else np.arange(24)[hours]
+            index = pd.Index(labels, name="hour")
+            return pd.Series(cube.sum(axis=(0, 1), dtype=np.float64), index=index)
+        raise ValueError("by must be eui, day, hour or None, got {}".format(by))
+
+
+def calculate_occupancy_durations(dataframe, now=None):
+    sessions = occupancy_sessions(dataframe, now)
+
+    return dict(zip(sessions["start"], sessions["duration_minutes"]))
 
-    condition = merged["Stamp"].isnull()
-    merged.loc[condition, "Stamp"] = my_list[: condition.sum()]
 
-    merged = merged[["index", "Date", "sequence", "Stamp"]]
+# ========================================PARSING PAYLOAD==========================================
 
-    return merged
 
+# Hex character -> nibble value, upper and lower case
+NIBBLE_VALUES = {char: int(char, 16) for char in "0123456789abcdefABCDEF"}
+
+# Header labels carried by the first nibble: bit 3 is occupancy, bit 2 battery,
+# bit 1 acknowledgment and bit 0 radar calibration
+OCCUPANCY_LABELS = ("Unoccupied", "Occupied")
+BATTERY_LABELS = ("Good Battery", "Low Battery")
+ACKNOWLEDGMENT_LABELS = ("Acknowledged", "Not Acknowledged")
+CALIBRATION_LABELS = (
+    "No radar calibration",
+    "Recalibration was done since last successful uplink",
+)
+
+# (occupancy, battery, acknowledgment, calibration) for every first nibble
+HEADER_TABLE = tuple(
+    (
+        OCCUPANCY_LABELS[(nibble >> 3) & 1],
+        BATTERY_LABELS[(nibble >> 2) & 1],
+        ACKNOWLEDGMENT_LABELS[(nibble >> 1) & 1],
+        CALIBRATION_LABELS[nibble & 1],
+    )
+    for nibble in range(16)
+)
 
-# ========================================OCCUPANCY==========================================
+# Short frame type names returned by frame_type, indexed by the second nibble
+FRAME_TYPE_NAMES = {
+    0: "info",
+    1: "keep-alive",
+    2: "Configuration Uplink",
+    4: "Start frame 1",
+    5: "Start frame 2",
+    7: "RTC Update",
+}
 
 
-def calculate_occupancy_durations(dataframe):
-    dataframe["createdDate"] = pd.to_datetime(
-        dataframe["createdDate"]
-    )  # Convert to datetime
-    dataframe.sort_values(by="createdDate", inplace=True)
-    dataframe.reset_index(drop=True, inplace=True)
-    duration_dict = {}
-    last_occupied_date = None
-
-    for index, row in dataframe.iterrows():
-        occupancy_status = row["occupancy_status"]
-        created_date = row["createdDate"]
-        message_log_time = int(
-            created_date.timestamp() * 1000
-        )  # Convert to milliseconds
-
-        if occupancy_status == "occupied":
-            if last_occupied_date is None:
-                last_occupied_date = created_date
-        elif last_occupied_date is not None:
-            current_time_milli = int(datetime.now().timestamp() * 1000)
-            duration_minutes = (
-                message_log_time - last_occupied_date.timestamp() * 1000
-            ) / 60000
-            duration_dict[last_occupied_date] = duration_minutes
-            last_occupied_date = None
-
-    # If the last entry is occupied, calculate its duration until the current time
-    if last_occupied_date is not None:
-        current_time_milli = int(datetime.now().timestamp() * 1000)
-        duration_minutes = (
-            current_time_milli - last_occupied_date.timestamp() * 1000
-        ) / 60000
-        duration_dict[last_occupied_date] = duration_minutes
-
-    return duration_dict
+def _nibble_chars(bit, value):
+    """
+    Hex characters, both cases, whose nibble has the given bit set to value.
+    """
+    return [char for char, nibble in NIBBLE_VALUES.items() if (nibble >> bit) & 1 == value]
 
 
-# ========================================PARSING PAYLOAD==========================================
+def _header_switch(bit, labels):
+    """
+    Mongo $switch mapping the first character of data to labels[bit value].
+    """
+    return {
+        "$switch": {
+            "branches": [
+                {
+                    "case": {"$in": [{"$substrCP": ["$data", 0, 1]}, _nibble_chars(bit, value)]},
+                    "then": label,
+                }
+                for value, label in enumerate(labels)
+            ],
+            "default": "Unknown",
+        }
+    }
 
 
 def status(row):
-    if row[0] in ["0", "1", "2", "3", "4", "5", "6", "7"]:
-        return "unoccupied"
-    elif row[0].lower() in ["8", "9", "a", "b", "c", "d", "e", "f"]:
-        return "occupied"
+    nibble = NIBBLE_VALUES.get(row[0])
+    if nibble is not None:
+        return HEADER_TABLE[nibble][0].lower()
 
 
 def frame_type(row):
-    if row[1] == "0":
-        return "info"
-    elif row[1] == "1":
-        return "keep-alive"
-    elif row[1] == "2":
-        return "Configuration Uplink"
-    elif row[1] == "4":
-        return "Start frame 1"
-    elif row[1] == "5":
-        return "Start frame 2"
-    elif row[1] == "7":
-        return "RTC Update"
+    nibble = NIBBLE_VALUES.get(row[1])
+    if nibble is not None:
+        return FRAME_TYPE_NAMES.get(nibble)
 
 
 def parse_sequence(row, base=16):
@@ -457,21 +1388,20 @@ def validate_voltage(row, base=16):
     """
     Get battery from Payload
     """
-    valid_c2 = ["7", "1", "4"]
-    frame_value = str(row)[1]
-    if frame_value in ["1", "7"]:  # Keep-Alive and RTC
-        hex_val = row[-2:]
-        int_val = int(hex_val, base)
-        bat_val = int_val * 4 + 2800
-        return bat_val
-    elif frame_value == "4":
-        hex_val = row[6:8]  # Start Frame
-        int_val = int(hex_val, base)
-        bat_val = int_val * 4 + 2800
-        return bat_val
-    else:
-        bat_val = np.nan
-        return bat_val
+    layout = FRAME_LAYOUTS.get(NIBBLE_VALUES.get(str(row)[1]))
+    if layout is not None:
+        for name, position, scale, offset, _ in layout["fields"]:
+            if name == "battery":
+                if position == -1:
+                    hex_val = row[-2:]  # Keep-Alive and RTC
+                else:
+                    hex_val = row[2 * position : 2 * position + 2]  # Start Frame
+                int_val = int(hex_val, base)
+                bat_val = int_val * scale + offset
+                return bat_val
+
+    bat_val = np.nan
+    return bat_val
 
 
 def validate_temperature(row, base=16):
@@ -516,122 +1446,27 @@ def date_range(start_date="2023-07-09", end_date="2023-07-10", selector_value=""
     return start_time_obj, end_time_obj
 
 
+# parse_header dicts for every first nibble, copied on use
+_PARSED_HEADERS = tuple(
+    dict(
+        zip(
+            ("occupancy_status", "battery_state", "acknowledgment", "radar calibration"),
+            labels,
+        )
+    )
+    for labels in HEADER_TABLE
+)
+
+
 def parse_header(row):
-    bit_00 = str(row)[0]
-    #     print(bit_000)
-    bit_01 = str(row)[1]
-    #     print(bit_001)
-    dict_bit_01 = dict()
+    bit_00 = NIBBLE_VALUES.get(str(row)[0])
+    bit_01 = NIBBLE_VALUES.get(str(row)[1])
 
-    if bit_00 == "0":
-        dict_bit_01["occupancy_status"] = "Unoccupied"
-        dict_bit_01["battery_state"] = "Good Battery"
-        dict_bit_01["acknowledgment"] = "Acknowledged"
-        dict_bit_01["radar calibration"] = "No radar calibration"
-    elif bit_00 == "1":
-        dict_bit_01["occupancy_status"] = "Unoccupied"
-        dict_bit_01["battery_state"] = "Good Battery"
-        dict_bit_01["acknowledgment"] = "Acknowledged"
-        dict_bit_01[
-            "radar calibration"
-        ] = "Recalibration was done since last successful uplink"
-    elif bit_00 == "2":
-        dict_bit_01["occupancy_status"] = "Unoccupied"
-        dict_bit_01["battery_state"] = "Good Battery"
-        dict_bit_01["acknowledgment"] = "Not Acknowledged"
-        dict_bit_01["radar calibration"] = "No radar calibration"
-    elif bit_00 == "3":
-        dict_bit_01["occupancy_status"] = "Unoccupied"
-        dict_bit_01["battery_state"] = "Good Battery"
-        dict_bit_01["acknowledgment"] = "Not Acknowledged"
-        dict_bit_01[
-            "radar calibration"
-        ] = "Recalibration was done since last successful uplink"
-    elif bit_00 == "4":
-        dict_bit_01["occupancy_status"] = "Unoccupied"
-        dict_bit_01["battery_state"] = "Low Battery"
-        dict_bit_01["acknowledgment"] = "Acknowledged"
-        dict_bit_01["radar calibration"] = "No radar calibration"
-    elif bit_00 == "5":
-        dict_bit_01["occupancy_status"] = "Unoccupied"
-        dict_bit_01["battery_state"] = "Low Battery"
-        dict_bit_01["acknowledgment"] = "Acknowledged"
-        dict_bit_01[
-            "radar calibration"
-        ] = "Recalibration was done since last successful uplink"
-    elif bit_00 == "6":
-        dict_bit_01["occupancy_status"] = "Unoccupied"
-        dict_bit_01["battery_state"] = "Low Battery"
-        dict_bit_01["acknowledgment"] = "Not Acknowledged"
-        dict_bit_01["radar calibration"] = "No radar calibration"
-    elif bit_00 == "7":
-        dict_bit_01["occupancy_status"] = "Unoccupied"
-        dict_bit_01["battery_state"] = "Low Battery"
-        dict_bit_01["acknowledgment"] = "Not Acknowledged"
-        dict_bit_01[
-            "radar calibration"
-        ] = "Recalibration was done since last successful uplink"
-    elif bit_00 == "8":
-        dict_bit_01["occupancy_status"] = "Occupied"
-        dict_bit_01["battery_state"] = "Good Battery"
-        dict_bit_01["acknowledgment"] = "Acknowledged"
-        dict_bit_01["radar calibration"] = "No radar calibration"
-    elif bit_00 == "9":
-        dict_bit_01["occupancy_status"] = "Occupied"
-        dict_bit_01["battery_state"] = "Good Battery"
-        dict_bit_01["acknowledgment"] = "Acknowledged"
-        dict_bit_01[
-            "radar calibration"
-        ] = "Recalibration was done since last successful uplink"
-    elif bit_00 == "a":
-        dict_bit_01["occupancy_status"] = "Occupied"
-        dict_bit_01["battery_state"] = "Good Battery"
-        dict_bit_01["acknowledgment"] = "Not Acknowledged"
-        dict_bit_01["radar calibration"] = "No radar calibration"
-    elif bit_00 == "b":
-        dict_bit_01["occupancy_status"] = "Occupied"
-        dict_bit_01["battery_state"] = "Good Battery"
-        dict_bit_01["acknowledgment"] = "Not Acknowledged"
-        dict_bit_01[
-            "radar calibration"
-        ] = "Recalibration was done since last successful uplink"
-    elif bit_00 == "c":
-        dict_bit_01["occupancy_status"] = "Occupied"
-        dict_bit_01["battery_state"] = "Low Battery"
-        dict_bit_01["acknowledgment"] = "Acknowledged"
-        dict_bit_01["radar calibration"] = "No radar calibration"
-    elif bit_00 == "d":
-        dict_bit_01["occupancy_status"] = "Occupied"
-        dict_bit_01["battery_state"] = "Low Battery"
-        dict_bit_01["acknowledgment"] = "Acknowledged"
-        dict_bit_01[
-            "radar calibration"
-        ] = "Recalibration was done since last successful uplink"
-    elif bit_00 == "e":
-        dict_bit_01["occupancy_status"] = "Occupied"
-        dict_bit_01["battery_state"] = "Low Battery"
-        dict_bit_01["acknowledgment"] = "Not Acknowledged"
-        dict_bit_01["radar calibration"] = "No radar calibration"
-    elif bit_00 == "f":
-        dict_bit_01["occupancy_status"] = "Occupied"
-        dict_bit_01["battery_state"] = "Low Battery"
-        dict_bit_01["acknowledgment"] = "Acknowledged"
-        dict_bit_01[
-            "radar calibration"
-        ] = "Recalibration was done since last successful uplink"
-
-    if bit_01 == "0":
-        dict_bit_01["Frame_Type"] = "Info Frame"
-    elif bit_01 == "1":
-        dict_bit_01["Frame_Type"] = "Keep-alive frame"
-    elif bit_01 == "2":
-        dict_bit_01["Frame_Type"] = "Configuration uplink"
-    elif bit_01 == "4":
-        dict_bit_01["Frame_Type"] = "Start frame 1"
-    elif bit_01 == "5":
-        dict_bit_01["Frame_Type"] = "Start frame 2"
-    elif bit_01 == "7":
-        dict_bit_01["Frame_Type"] = "RTC update"
+    dict_bit_01 = dict()
+    if bit_00 is not None:
+        dict_bit_01.update(_PARSED_HEADERS[bit_00])
+    if bit_01 in FRAME_LAYOUTS:
+        dict_bit_01["Frame_Type"] = FRAME_LAYOUTS[bit_01]["name"]
     return dict_bit_01
 
 
@@ -644,16 +1479,7 @@ def parse_startframe_1(row, base=16):
     hex_val_fw = row[4:6]  # For Firmware value
     fw_val = int(hex_val_fw, base)
 
-    if fw_val == 31:
-        fw_val_version = "v1.1.1"
-    elif fw_val == 32:
-        fw_val_version = "v1.1.2"
-    elif fw_val == 33:
-        fw_val_version = "v1.1.3"
-    elif fw_val == 34:
-        fw_val_version = "v1.1.4"
-    else:
-        fw_val_version = "None"
+    fw_val_version = FIRMWARE_VERSIONS.get(fw_val, "None")
 
     hex_val_bat = row[6:8]  # For Battery
     int_val_bat = int(hex_val_bat, base)
@@ -841,163 +1667,1199 @@ def parse_rtc_update(row, base=16):
     return dict_rtc_update
 
 
+# Per-row parser of every frame type and the key main_function reports it under
+_FRAME_PARSERS = {
+    "4": ("Startframe 1 Parsing", parse_startframe_1),
+    "5": ("Startframe 2 Parsing", parse_startframe_2),
+    "0": ("Info frame Parsing", parse_infoframe),
+    "1": ("Keep-alive frame Parsing", parse_keepalive),
+    "7": ("RTC update Parsing", parse_rtc_update),
+}
+
+
 def main_function(row):
-    # Call individual functions
-    result1 = parse_header(row)
-    result2 = parse_startframe_1(row)
-    result3 = parse_startframe_2(row)
-    result4 = parse_infoframe(row)
-    result5 = parse_keepalive(row)
-    result6 = parse_rtc_update(row)
-
-    # Combine results
+    # Only the parser matching the frame type is called, the others stay empty
     combined_results = {
-        "Header Parsing": result1,
-        "Startframe 1 Parsing": result2,
-        "Startframe 2 Parsing": result3,
-        "Info frame Parsing": result4,
-        "Keep-alive frame Parsing": result5,
-        "RTC update Parsing": result6,
+        "Header Parsing": parse_header(row),
+        "Startframe 1 Parsing": {},
+        "Startframe 2 Parsing": {},
+        "Info frame Parsing": {},
+        "Keep-alive frame Parsing": {},
+        "RTC update Parsing": {},
     }
 
+    parser = _FRAME_PARSERS.get(str(row)[1])
+    if parser is not None:
+        key, parse = parser
+        combined_results[key] = parse(row)
+
     return combined_results
 
 
-# ========================================ABSENTEES & REAWAKEN==========================================
+# ========================================BULK PAYLOAD DECODING==========================================
+
+# Payloads are at most 10 bytes (20 hex characters) long
+PAYLOAD_BYTES = 10
+
+# Hex payloads are cut to this many characters before they are decoded, so
+# a malformed long string cannot size the character matrix of a whole
+# batch; a row still longer than 2 * PAYLOAD_BYTES after the cut is oversized
+PAYLOAD_CHARS = 2 * PAYLOAD_BYTES + 2
+
+# Every ASCII code mapped to its hex nibble value
+_HEX_NIBBLES = np.zeros(256, dtype=np.uint8)
+for _char, _nibble in NIBBLE_VALUES.items():
+    _HEX_NIBBLES[ord(_char)] = _nibble
+
+# Every character code that is neither a hex character nor the NUL padding
+_NON_HEX = np.ones(256, dtype=bool)
+_NON_HEX[0] = False
+for _char in NIBBLE_VALUES:
+    _NON_HEX[ord(_char)] = False
+
+# Reason codes of validate_payloads, indexing PAYLOAD_REJECT_REASONS
+PAYLOAD_OK = 0
+PAYLOAD_MISSING = 1
+PAYLOAD_NON_HEX = 2
+PAYLOAD_ODD_LENGTH = 3
+PAYLOAD_TRUNCATED = 4
+PAYLOAD_OVERSIZED = 5
+PAYLOAD_REJECT_REASONS = (
+    "ok",
+    "missing",
+    "non-hex character",
+    "odd length",
+    "truncated frame",
+    "oversized",
+)
+
+# Firmware codes reported by Start frame 1
+FIRMWARE_VERSIONS = {31: "v1.1.1", 32: "v1.1.2", 33: "v1.1.3", 34: "v1.1.4"}
+
+# Frame layouts keyed by the second nibble of the payload.
+# Each field is (name, byte position, scale, offset, dtype) and decodes as
+# int(byte) * scale + offset; a byte position of -1 reads the last byte,
+# like row[-2:] does.
+FRAME_LAYOUTS = {
+    0x0: {
+        "name": "Info Frame",
+        "fields": [
+            ("sequence", 1, 1, 0, "UInt8"),
+            ("radar_error", 2, 1, 0, "UInt8"),
+            ("temperature", 3, 1, 0, "UInt8"),
+            ("timestamp_hh", 4, 1, 0, "UInt8"),
+            ("timestamp_mm", 5, 1, 0, "UInt8"),
+        ],
+    },
+    0x1: {
+        "name": "Keep-alive frame",
+        "fields": [
+            ("sequence", 1, 1, 0, "UInt8"),
+            ("radar_error", 2, 1, 0, "UInt8"),
+            ("temperature", 3, 1, 0, "UInt8"),
+            ("timestamp_hh", 4, 1, 0, "UInt8"),
+            ("timestamp_mm", 5, 1, 0, "UInt8"),
+            ("battery", -1, 4, 2800, "Int16"),
+        ],
+    },
+    0x2: {
+        # Only the common header is documented for configuration uplinks
+        "name": "Configuration uplink",
+        "fields": [
+            ("sequence", 1, 1, 0, "UInt8"),
+        ],
+    },
+    0x4: {
+        "name": "Start frame 1",
+        "fields": [
+            ("sequence", 1, 1, 0, "UInt8"),
+            ("firmware", 2, 1, 0, "UInt8"),
+            ("battery", 3, 4, 2800, "Int16"),
+            ("radar_threshold", 4, 100, 0, "Int32"),
+            ("radar_range_start", 5, 1, 0, "UInt8"),
+            ("radar_range_length", 6, 1, 20, "Int16"),
+            ("lorawan_join_mode", 7, 1, 0, "UInt8"),
+            ("lorawan_adr", 8, 1, 0, "UInt8"),
+            ("reset_source_bitmap", 9, 1, 0, "UInt8"),
+        ],
+    },
+    0x5: {
+        "name": "Start frame 2",
+        "fields": [
+            ("sequence", 1, 1, 0, "UInt8"),
+            ("sleep_time_minutes", 2, 1, 0, "UInt8"),
+            ("sleep_time_seconds", 3, 1, 0, "UInt8"),
+            ("keep_alive", 4, 1, 0, "UInt8"),
+            ("night_mode", 5, 1, 0, "UInt8"),
+            ("night_mode_start_hour", 6, 1, 0, "UInt8"),
+            ("night_mode_duration", 7, 1, 0, "UInt8"),
+            ("night_mode_sleep_time", 8, 1, 0, "UInt8"),
+            ("night_mode_keep_alive", 9, 1, 0, "UInt8"),
+        ],
+    },
+    0x7: {
+        "name": "RTC update",
+        "fields": [
+            ("sequence", 1, 1, 0, "UInt8"),
+            ("radar_error", 2, 1, 0, "UInt8"),
+            ("temperature", 3, 1, 0, "UInt8"),
+            ("timestamp_hh", 4, 1, 0, "UInt8"),
+            ("timestamp_mm", 5, 1, 0, "UInt8"),
+            ("battery", -1, 4, 2800, "Int16"),
+        ],
+    },
+}
+
+# Raw payload types accepted next to hex strings
+_BINARY_TYPES = (bytes, bytearray, memoryview)
+
+# Label columns derived from a decoded field: field -> (column, labels, default)
+FIELD_LABELS = {"firmware": ("firmware_version", FIRMWARE_VERSIONS, "None")}
+
+
+def register_frame_layout(nibble, name, fields, record=None):
+    """
+    Add or replace the layout of a frame type.
+    fields is a list of (name, byte position, scale, offset, dtype); record
+    is the record type decode_record returns for it, a plain namedtuple of
+    the field names when not given.
+    """
+    if not 0 <= nibble <= 15:
+        raise ValueError("Frame type nibble must be between 0 and 15, got {}".format(nibble))
+    FRAME_LAYOUTS[nibble] = {"name": name, "fields": list(fields)}
+    if record is None:
+        record = namedtuple("Frame{:X}".format(nibble), [field[0] for field in fields])
+    FRAME_RECORDS[nibble] = record
 
 
-def grab_reports_for_comparison(input_date, DIR_daily_reports):
-    all_files = os.listdir(DIR_daily_reports)
-    # Filter files that match the naming pattern
-    report_files = [
-        file
-        for file in all_files
-        if file.startswith("Daily Report for ") and file.endswith(".xlsx")
-    ]
+def _layout_columns(layouts=None):
+    """
+    Every field column of the registry with its dtype, in registry order.
+    """
+    layouts = FRAME_LAYOUTS if layouts is None else layouts
+    columns = {}
+    for nibble in sorted(layouts):
+        for name, _, _, _, dtype in layouts[nibble]["fields"]:
+            columns.setdefault(name, dtype)
+    return columns
 
-    # Extract dates from the report names and convert to datetime objects
-    report_dates = [
-        datetime.strptime(report.split(" ")[3], "%Y-%m-%d") for report in report_files
-    ]
-    str_report_dates = [date.strftime("%Y-%m-%d") for date in report_dates]
-    # Convert input_date to datetime object
-    input_datetime = datetime.strptime(input_date, "%Y-%m-%d")
-    # Convert each date in list_of_dates to datetime objects
-    date_objects = [datetime.strptime(date, "%Y-%m-%d") for date in str_report_dates]
-    # Find the last date before the input date in the list
-    last_date = max(date for date in date_objects if date < input_datetime)
 
-    # Convert last_date to string in the original format
-    last_date_str = last_date.strftime("%Y-%m-%d")
-    name_report_yesterday = next(
-        (date for date in report_files if last_date_str in date), None
-    )
-    name_report_today = next(
-        (date for date in report_files if input_date in date), None
-    )
+def _split_payload(row, base=16):
+    """
+    First nibble, second nibble and readable payload of one hex string
+    or raw bytes/bytearray/memoryview payload.
+    """
+    if isinstance(row, _BINARY_TYPES):
+        # Raw bytes are read directly, no hex string in between
+        payload = memoryview(row).cast("B")
+        return payload[0] >> 4, payload[0] & 0x0F, payload
 
-    report_yesterday = pd.read_excel(
-        DIR_daily_reports + "/" + name_report_yesterday, sheet_name="All Sensors"
-    )
-    report_today = pd.read_excel(
-        DIR_daily_reports + "/" + name_report_today, sheet_name="All Sensors"
-    )
+    row = str(row)
+    return NIBBLE_VALUES.get(row[0]), int(row[1], base), row
 
-    report_yesterday["EUI"] = report_yesterday["EUI"].str.strip()
-    report_today["EUI"] = report_today["EUI"].str.strip()
 
-    # Yesterday's awake EUIs
-    abs0_repy = (
-        report_yesterday[
-            report_yesterday["Days since sensor sent its Last message (Days)"] == "0"
-        ]["EUI"]
-        .str.strip()
-        .tolist()
-    )
-    # Yesterday's 1 day absentees
-    abs1_repy = (
-        report_yesterday[
-            report_yesterday["Days since sensor sent its Last message (Days)"] == "1"
-        ]["EUI"]
-        .str.strip()
-        .tolist()
-    )
+def _field_values(payload, fields, base=16):
+    """
+    Decoded values of the layout fields, in layout order.
+    """
+    values = []
+    for _, position, scale, offset, _ in fields:
+        if isinstance(payload, memoryview):
+            int_val = payload[position]
+        elif position == -1:
+            int_val = int(payload[-2:], base)
+        else:
+            int_val = int(payload[2 * position : 2 * position + 2], base)
+        values.append(int_val * scale + offset)
+    return values
 
-    # Today's awake EUIs
-    abs0_rept = (
-        report_today[
-            report_today["Days since sensor sent its Last message (Days)"] == "0"
-        ]["EUI"]
-        .str.strip()
-        .tolist()
-    )
 
-    # Today's 1 day absentees
-    abs1_rept = (
-        report_today[
-            report_today["Days since sensor sent its Last message (Days)"] == "1"
-        ]["EUI"]
-        .str.strip()
-        .tolist()
-    )
+def decode_frame(row, base=16):
+    """
+    Decode the fields of one payload, dispatching once on its frame type.
+    The payload is a hex string or raw bytes/bytearray/memoryview.
+    Returns an empty dict for frame types without a layout.
+    """
+    _, frame, payload = _split_payload(row, base)
+    layout = FRAME_LAYOUTS.get(frame)
+    if layout is None:
+        return {}
 
-    # Comparison: New 1 day absentees
-    sleepies_eui = [eui for eui in abs1_rept if eui in abs0_repy]
-    new_sleepies = len(sleepies_eui)
+    decoded = {"frame_type": layout["name"]}
+    fields = layout["fields"]
+    decoded.update(zip((field[0] for field in fields), _field_values(payload, fields, base)))
 
-    # Comparison: EUIs that woke up
-    woken_up_eui = [eui for eui in abs0_rept if eui in abs1_repy]
-    new_woken_up = len(woken_up_eui)
+    for name, (column, labels, default) in FIELD_LABELS.items():
+        if name in decoded:
+            decoded[column] = labels.get(decoded[name], default)
 
-    return new_sleepies, new_woken_up, sleepies_eui, woken_up_eui
+    return decoded
 
 
-# ****************************************************************************************************
+def _hex_ascii_matrix(payloads):
+    """
+    Turn a column of hex payloads into a (rows, characters) uint8 matrix
+    of character codes, zero padded on the right. Characters past ASCII
+    become 255, which is not a hex character either. Payloads are cut to
+    PAYLOAD_CHARS characters, so the matrix is never wider than that.
+    """
+    text = pd.Series(payloads).fillna("").astype(str).str.slice(0, PAYLOAD_CHARS).to_numpy()
+    if len(text) == 0:
+        return np.zeros((0, 2 * PAYLOAD_BYTES), dtype=np.uint8)
+
+    # Fixed width unicode array, one uint32 code point per character
+    codes = np.asarray(text, dtype="U").view(np.uint32).reshape(len(text), -1)
+    return np.where(codes > 255, 255, codes).astype(np.uint8)
+
+
+def _ascii_to_bytes(ascii_codes):
+    """
+    Turn a character code matrix into a (rows, bytes) uint8 matrix and the
+    number of bytes held by every payload.
+    """
+    n_chars = np.count_nonzero(ascii_codes, axis=1)
+
+    nibbles = _HEX_NIBBLES[ascii_codes]
+    if nibbles.shape[1] % 2:
+        nibbles = np.pad(nibbles, ((0, 0), (0, 1)))
+    data = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+
+    return data, n_chars // 2
+
+
+def _binary_to_byte_matrix(payloads, frame_size=None, lengths=None):
+    """
+    Turn raw binary payloads into a (rows, bytes) uint8 matrix and the
+    number of bytes held by every payload, without any hex strings.
+    With frame_size, payloads is one buffer of concatenated fixed width
+    frames and the matrix is a zero-copy view over it. Frames padded up to
+    frame_size need their own byte count in lengths, since last byte fields
+    are read at the end of the payload, not at the end of the frame.
+    """
+    if frame_size is not None:
+        buffer = np.frombuffer(payloads, dtype=np.uint8)
+        if len(buffer) % frame_size:
+            raise ValueError(
+                "Buffer of {} bytes is not a whole number of {} byte frames".format(
+                    len(buffer), frame_size
+                )
+            )
+        data = buffer.reshape(-1, frame_size)
+        if lengths is None:
+            return data, np.full(len(data), frame_size, dtype=np.int64)
+
+        n_bytes = np.asarray(lengths, dtype=np.int64)
+        if n_bytes.shape != (len(data),):
+            raise ValueError("Expected {} frame lengths, got {}".format(len(data), n_bytes.size))
+        if ((n_bytes < 0) | (n_bytes > frame_size)).any():
+            raise ValueError("Frame lengths must be between 0 and {}".format(frame_size))
+        return data, n_bytes
+
+    if isinstance(payloads, _BINARY_TYPES):
+        payloads = [payloads]
+    payloads = [b"" if payload is None else payload for payload in payloads]
+    n_bytes = np.fromiter(
+        (memoryview(payload).nbytes for payload in payloads), dtype=np.int64, count=len(payloads)
+    )
+    buffer = np.frombuffer(b"".join(payloads), dtype=np.uint8)
+
+    width = max(int(n_bytes.max()) if len(n_bytes) else 0, PAYLOAD_BYTES)
+    if len(n_bytes) and (n_bytes == width).all():
+        return buffer.reshape(-1, width), n_bytes
+
+    # Scatter variable length payloads into a zero padded matrix
+    data = np.zeros((len(n_bytes), width), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(n_bytes)), n_bytes)
+    starts = np.cumsum(n_bytes) - n_bytes
+    data[rows, np.arange(len(buffer)) - starts[rows]] = buffer
+
+    return data, n_bytes
+
+
+def _required_bytes(layouts=None):
+    """
+    Minimum payload length in bytes of every frame type nibble.
+    A last byte field needs one byte past the other fields.
+    """
+    layouts = FRAME_LAYOUTS if layouts is None else layouts
+    required = np.ones(16, dtype=np.int64)
+    for nibble, layout in layouts.items():
+        positions = [field[1] for field in layout["fields"]]
+        length = max([position + 1 for position in positions if position >= 0] + [1])
+        if -1 in positions:
+            length += 1
+        required[nibble] = length
+    return required
+
+
+def _byte_reasons(data, n_bytes, layouts=None):
+    """
+    Reason codes of missing and truncated payloads in a byte matrix.
+    """
+    frame = data[:, 0] & 0x0F if data.shape[1] else np.zeros(len(data), dtype=np.uint8)
+    truncated = n_bytes < _required_bytes(layouts)[frame]
+    return np.select(
+        [n_bytes == 0, truncated], [PAYLOAD_MISSING, PAYLOAD_TRUNCATED], PAYLOAD_OK
+    ).astype(np.int8)
+
+
+def _character_reasons(ascii_codes, reasons=PAYLOAD_OK):
+    """
+    Reason codes of missing, oversized, non-hex and odd length rows of a
+    character code matrix; the other rows keep reasons.
+    """
+    n_chars = np.count_nonzero(ascii_codes, axis=1)
+    non_hex = _NON_HEX[ascii_codes].any(axis=1)
+    return np.select(
+        [n_chars == 0, n_chars > 2 * PAYLOAD_BYTES, non_hex, n_chars % 2 == 1],
+        [PAYLOAD_MISSING, PAYLOAD_OVERSIZED, PAYLOAD_NON_HEX, PAYLOAD_ODD_LENGTH],
+        reasons,
+    ).astype(np.int8)
+
+
+def _ascii_reasons(ascii_codes, data, n_bytes, layouts=None):
+    """
+    Reason codes of a character code matrix and its byte matrix.
+    """
+    return _character_reasons(ascii_codes, _byte_reasons(data, n_bytes, layouts))
+
+
+def _decode_valid_rows(data, n_bytes, reasons, layouts=None):
+    """
+    Decode only the rows without a reject reason, the others stay missing.
+    """
+    columns = _decode_byte_matrix(data, np.where(reasons == PAYLOAD_OK, n_bytes, 0), layouts)
+    columns["reject_reason"] = (reasons, np.ones(len(reasons), dtype=bool))
+    return columns
+
+
+def _decode_ascii_matrix(ascii_codes, layouts=None):
+    """
+    Validate and decode a character code matrix of hex payloads.
+    """
+    data, n_bytes = _ascii_to_bytes(ascii_codes)
+    reasons = _ascii_reasons(ascii_codes, data, n_bytes, layouts)
+    return _decode_valid_rows(data, n_bytes, reasons, layouts)
+
+
+def _decode_byte_matrix(data, n_bytes, layouts=None):
+    """
+    Decode a byte matrix into numeric columns, touching every row only
+    with the layout of its own frame type.
+    Returns a dict of column -> (values, valid mask).
+    """
+    layouts = FRAME_LAYOUTS if layouts is None else layouts
+    if data.shape[1] < PAYLOAD_BYTES:
+        data = np.pad(data, ((0, 0), (0, PAYLOAD_BYTES - data.shape[1])))
+
+    has_header = n_bytes > 0
+    header = data[:, 0] >> 4
+    frame = data[:, 0] & 0x0F
+
+    columns = {
+        "header_code": (header, has_header),
+        "frame_code": (frame, has_header),
+    }
+    for column in _layout_columns(layouts):
+        columns[column] = (np.zeros(len(data), dtype=np.int32), np.zeros(len(data), dtype=bool))
+
+    for nibble, layout in layouts.items():
+        rows = np.flatnonzero(has_header & (frame == nibble))
+        if len(rows) == 0:
+            continue
+        row_bytes = n_bytes[rows]
+        for name, position, scale, offset, _ in layout["fields"]:
+            values, valid = columns[name]
+            if position == -1:
+                raw = data[rows, row_bytes - 1]
+                valid[rows] = True
+            else:
+                raw = data[rows, position]
+                valid[rows] = row_bytes > position
+            values[rows] = raw.astype(np.int32) * scale + offset
+
+    return columns
+
+
+def _categorical(codes, valid, categories):
+    """
+    Categorical over categories from integer codes, missing where not valid.
+    """
+    codes = np.where(valid, np.asarray(codes, dtype=np.int64), -1)
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+
+def _mapping_categorical(mapping, codes, valid, default=None):
+    """
+    Categorical of mapping[code] for integer codes; codes outside the mapping
+    get default, or are missing when there is no default.
+    """
+    categories = list(dict.fromkeys(mapping.values()))
+    lookup = np.full(256, -1, dtype=np.int64)
+    if default is not None:
+        categories.append(default)
+        lookup[:] = len(categories) - 1
+    for code, label in mapping.items():
+        lookup[code] = categories.index(label)
+    return _categorical(lookup[codes], valid, categories)
+
+
+def _header_categoricals(header, frame, has_header):
+    """
+    Header and frame type label columns from the first payload byte.
+    """
+    frame_names = {nibble: layout["name"] for nibble, layout in sorted(FRAME_LAYOUTS.items())}
+    return {
+        "occupancy_status": _categorical((header >> 3) & 1, has_header, OCCUPANCY_LABELS),
+        "battery_state": _categorical((header >> 2) & 1, has_header, BATTERY_LABELS),
+        "acknowledgment": _categorical((header >> 1) & 1, has_header, ACKNOWLEDGMENT_LABELS),
+        "radar_calibration": _categorical(header & 1, has_header, CALIBRATION_LABELS),
+        "frame_type": _mapping_categorical(frame_names, frame, has_header),
+    }
+
+
+def _decoded_columns_to_frame(columns, index=None):
+    """
+    Turn the numeric columns of _decode_byte_matrix into a typed DataFrame,
+    with label columns as categoricals.
+    """
+    header, has_header = columns["header_code"]
+    frame, _ = columns["frame_code"]
+    frame_data = _header_categoricals(header, frame, has_header)
+
+    for column, dtype in _layout_columns().items():
+        values, valid = columns[column]
+        frame_data[column] = pd.arrays.IntegerArray(
+            values.astype(_NUMPY_DTYPES[dtype]), ~np.asarray(valid, dtype=bool)
+        )
+
+    for name, (column, labels, default) in FIELD_LABELS.items():
+        values, valid = columns[name]
+        frame_data[column] = _mapping_categorical(labels, values, valid, default)
+
+    reasons, valid = columns["reject_reason"]
+    frame_data["reject_reason"] = _categorical(reasons, valid, PAYLOAD_REJECT_REASONS)
+
+    return pd.DataFrame(frame_data, index=index)
+
+
+def decode_payloads(payloads):
+    """
+    Decode a whole column of hex payloads at once.
+    Returns one row per payload with the header, frame type and every
+    frame field; fields that do not belong to a frame type are missing.
+    Malformed payloads are skipped rather than raising: all their fields
+    are missing and reject_reason tells why.
+    """
+    index = payloads.index if isinstance(payloads, pd.Series) else None
+    columns = _decode_ascii_matrix(_hex_ascii_matrix(payloads))
+    return _decoded_columns_to_frame(columns, index)
+
+
+def validate_payloads(payloads):
+    """
+    Check a whole column of hex payloads without raising.
+    Returns a boolean validity mask and an array of reason codes indexing
+    PAYLOAD_REJECT_REASONS (missing, non-hex character, odd length,
+    shorter than its frame layout or longer than PAYLOAD_BYTES).
+    """
+    ascii_codes = _hex_ascii_matrix(payloads)
+    data, n_bytes = _ascii_to_bytes(ascii_codes)
+    reasons = _ascii_reasons(ascii_codes, data, n_bytes)
+    return reasons == PAYLOAD_OK, reasons
+
+
+def rejection_counts(reasons):
+    """
+    Number of payloads per reason code, labelled with PAYLOAD_REJECT_REASONS.
+    """
+    counts = np.bincount(np.asarray(reasons, dtype=np.int64), minlength=len(PAYLOAD_REJECT_REASONS))
+    return pd.Series(counts, index=list(PAYLOAD_REJECT_REASONS), name="count")
+
+
+def decode_headers(payloads):
+    """
+    Decode only the header of a whole column of hex payloads.
+    Returns categorical occupancy, battery, acknowledgment, calibration
+    and frame type columns, missing where the header byte is missing, cut
+    short or not hex, and reject_reason telling why, like decode_payloads.
+    """
+    index = payloads.index if isinstance(payloads, pd.Series) else None
+    ascii_codes = _hex_ascii_matrix(pd.Series(payloads).str[:2])
+    data, _ = _ascii_to_bytes(ascii_codes)
+    reasons = _character_reasons(ascii_codes)
+    header = data[:, 0] >> 4
+    frame = data[:, 0] & 0x0F
+    columns = _header_categoricals(header, frame, reasons == PAYLOAD_OK)
+    columns["reject_reason"] = _categorical(
+        reasons, np.ones(len(reasons), dtype=bool), PAYLOAD_REJECT_REASONS
+    )
+    return pd.DataFrame(columns, index=index)
+
+
+def decode_payload_bytes(payloads, frame_size=None, lengths=None):
+    """
+    Decode raw binary payloads at once, as received from the network server.
+    payloads is a bytes/bytearray/memoryview payload, an iterable of them,
+    or, with frame_size, one buffer of concatenated fixed width frames.
+    lengths gives the payload bytes of every fixed width frame when frames
+    are zero padded; without it every frame is frame_size bytes long.
+    Returns the same columns as decode_payloads.
+    """
+    index = payloads.index if isinstance(payloads, pd.Series) else None
+    data, n_bytes = _binary_to_byte_matrix(payloads, frame_size, lengths)
+    columns = _decode_valid_rows(data, n_bytes, _byte_reasons(data, n_bytes))
+    return _decoded_columns_to_frame(columns, index)
+
+
+# ========================================DECODED RECORDS==========================================
+
+# numpy dtypes of the nullable pandas dtypes used by the layouts
+_NUMPY_DTYPES = {"UInt8": "u1", "Int16": "i2", "Int32": "i4"}
+
+
+def _frame_record(name, nibble):
+    """
+    Slotted record type holding the fields of one frame layout.
+    """
+    return namedtuple(name, [field[0] for field in FRAME_LAYOUTS[nibble]["fields"]])
+
+
+class Header(namedtuple("Header", ["flags", "frame"])):
+    """
+    Payload header as its two nibbles, labels are looked up on access.
+    """
+
+    __slots__ = ()
+
+    @property
+    def occupancy_status(self):
+        return HEADER_TABLE[self.flags][0]
+
+    @property
+    def battery_state(self):
+        return HEADER_TABLE[self.flags][1]
+
+    @property
+    def acknowledgment(self):
+        return HEADER_TABLE[self.flags][2]
+
+    @property
+    def radar_calibration(self):
+        return HEADER_TABLE[self.flags][3]
+
+    @property
+    def frame_type(self):
+        layout = FRAME_LAYOUTS.get(self.frame)
+        return layout["name"] if layout is not None else None
+
+
+# One shared Header per possible first byte
+_HEADERS = tuple(Header(flags, frame) for flags in range(16) for frame in range(16))
+
+InfoFrame = _frame_record("InfoFrame", 0x0)
+KeepAlive = _frame_record("KeepAlive", 0x1)
+ConfigurationUplink = _frame_record("ConfigurationUplink", 0x2)
+StartFrame2 = _frame_record("StartFrame2", 0x5)
+RtcUpdate = _frame_record("RtcUpdate", 0x7)
+
+
+class StartFrame1(_frame_record("StartFrame1", 0x4)):
+    """
+    Start frame 1 fields, with the firmware label looked up on access.
+    """
+
+    __slots__ = ()
+
+    @property
+    def firmware_version(self):
+        return FIRMWARE_VERSIONS.get(self.firmware, "None")
+
+
+# Record type of every frame type nibble
+FRAME_RECORDS = {
+    0x0: InfoFrame,
+    0x1: KeepAlive,
+    0x2: ConfigurationUplink,
+    0x4: StartFrame1,
+    0x5: StartFrame2,
+    0x7: RtcUpdate,
+}
+
+
+def decode_record(row, base=16):
+    """
+    Decode one hex or binary payload into a (Header, frame record) pair.
+    The frame record is None for frame types without a layout.
+    """
+    flags, frame, payload = _split_payload(row, base)
+    header = _HEADERS[(flags << 4) | frame] if flags is not None else None
+
+    layout = FRAME_LAYOUTS.get(frame)
+    if layout is None:
+        return header, None
+    record = FRAME_RECORDS[frame]
+    return header, record._make(_field_values(payload, layout["fields"], base))
+
+
+def record_dtype(record_type):
+    """
+    Structured numpy dtype matching the fields of a record type.
+    """
+    if issubclass(record_type, Header):
+        return np.dtype([("flags", "u1"), ("frame", "u1")])
+
+    for nibble, candidate in FRAME_RECORDS.items():
+        if candidate is record_type:
+            fields = FRAME_LAYOUTS[nibble]["fields"]
+            return np.dtype([(name, _NUMPY_DTYPES[dtype]) for name, _, _, _, dtype in fields])
+
+    raise ValueError("{} is not a registered frame record".format(record_type.__name__))
+
+
+def records_to_array(records, record_type=None):
+    """
+    Turn a list of records of one type into a structured numpy array.
+    record_type is only needed to type an empty list.
+    """
+    records = list(records)
+    if record_type is None:
+        if not records:
+            raise ValueError("record_type is needed to convert an empty list")
+        record_type = type(records[0])
+
+    return np.array(records, dtype=record_dtype(record_type))
+
+
+# ========================================DECODE CACHE==========================================
+
+
+class DecodeCache:
+    """
+    Bounded LRU cache in front of a per-payload decoder.
+    Cached results are shared between callers, so the decoder must return
+    immutable values such as the records of decode_record.
+    """
+
+    def __init__(self, maxsize=65536, decoder=decode_record):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, got {}".format(maxsize))
+        self.maxsize = maxsize
+        self.decoder = decoder
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __call__(self, row):
+        # bytearray and memoryview are not hashable
+        key = bytes(row) if isinstance(row, _BINARY_TYPES) else row
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+        value = self.decoder(row)
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def stats(self):
+        """
+        Hit, miss and eviction counters with the current fill.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        """
+        Drop every entry and reset the counters.
+        """
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+def decode_records(payloads, cache=None):
+    """
+    Decode a column of payloads into (Header, frame record) pairs,
+    through a DecodeCache when one is given.
+    """
+    decode = cache if cache is not None else decode_record
+    return [decode(row) for row in payloads]
+
+
+# ========================================STREAMING DECODE==========================================
+
+
+def stream_decoded_payloads(
+    documents, batch_size=50000, data_field="data", columns=("eui", "createdDate", "fcnt")
+):
+    """
+    Decode the payloads of raw uplink documents in fixed size batches.
+    documents is any iterable of documents, such as a Mongo cursor or a
+    generator. Yields one DataFrame per batch holding the document columns
+    next to the decode_payloads columns, so memory is bounded by batch_size
+    and not by the size of the window.
+    """
+    iterator = iter(documents)
+    start = 0
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+
+        decoded = decode_payloads([document.get(data_field) for document in batch])
+        decoded.index = pd.RangeIndex(start, start + len(batch))
+        for position, column in enumerate(columns):
+            decoded.insert(position, column, [document.get(column) for document in batch])
+
+        start += len(batch)
+        yield decoded
+
+
+def stream_uplinks_decoded(
+    conn, start_time_obj, end_time_obj, database, collection, batch_size=50000
+):
+    """
+    Stream the decoded uplinks of a window straight from the Mongo cursor,
+    one DataFrame of batch_size rows at a time.
+    """
+    db = conn[database]
+    collection = db[collection]
+
+    pipeline = [
+        {
+            "$match": {
+                "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
+                "cmd": "rx",
+            }
+        },
+        {"$project": {"eui": 1, "createdDate": 1, "fcnt": 1, "data": 1}},
+    ]
+    cursor = collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    return stream_decoded_payloads(cursor, batch_size=batch_size)
+
+
+# ========================================PARALLEL DECODE==========================================
+
+# Below this many payloads the pool start-up costs more than it saves
+PARALLEL_MIN_ROWS = 200000
+
+
+def _decode_shared_shard(ascii_name, ascii_shape, output_name, output_shape, layouts, start, stop):
+    """
+    Decode rows start:stop of the shared character code matrix into the
+    shared output block. Runs in a worker process.
+    """
+    ascii_memory = shared_memory.SharedMemory(name=ascii_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
+    try:
+        ascii_codes = np.ndarray(ascii_shape, dtype=np.uint8, buffer=ascii_memory.buf)
+        output = np.ndarray(output_shape, dtype=np.int32, buffer=output_memory.buf)
+
+        columns = _decode_ascii_matrix(ascii_codes[start:stop], layouts)
+
+        # Every column takes two output rows: its values and its valid mask
+        for position, (values, valid) in enumerate(columns.values()):
+            output[2 * position, start:stop] = values
+            output[2 * position + 1, start:stop] = valid
+        del ascii_codes, output
+    finally:
+        ascii_memory.close()
+        output_memory.close()
+
+
+def decode_payloads_parallel(payloads, workers=None, min_rows=PARALLEL_MIN_ROWS):
+    """
+    Decode a column of hex payloads across a process pool.
+    The payloads go to the workers as one shared memory matrix of character
+    codes and come back as one shared memory block of numeric columns, so
+    no strings are pickled. Falls back to decode_payloads in-process with one
+    worker or fewer than min_rows payloads. Returns the same columns as
+    decode_payloads, in input order.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(payloads) < min_rows:
+        return decode_payloads(payloads)
+
+    index = payloads.index if isinstance(payloads, pd.Series) else None
+    ascii_codes = _hex_ascii_matrix(payloads)
+    ascii_shape = ascii_codes.shape
+    column_names = ["header_code", "frame_code"] + list(_layout_columns()) + ["reject_reason"]
+    output_shape = (2 * len(column_names), len(ascii_codes))
+
+    ascii_memory = shared_memory.SharedMemory(create=True, size=max(ascii_codes.nbytes, 1))
+    output_memory = shared_memory.SharedMemory(
+        create=True, size=max(4 * output_shape[0] * output_shape[1], 1)
+    )
+    try:
+        shared_ascii = np.ndarray(ascii_shape, dtype=np.uint8, buffer=ascii_memory.buf)
+        shared_ascii[:] = ascii_codes
+        del ascii_codes, shared_ascii
+
+        bounds = np.linspace(0, output_shape[1], workers + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    _decode_shared_shard,
+                    ascii_memory.name,
+                    ascii_shape,
+                    output_memory.name,
+                    output_shape,
+                    FRAME_LAYOUTS,
+                    start,
+                    stop,
+                )
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ]
+            for future in futures:
+                future.result()
+
+        output = np.ndarray(output_shape, dtype=np.int32, buffer=output_memory.buf).copy()
+    finally:
+        ascii_memory.close()
+        ascii_memory.unlink()
+        output_memory.close()
+        output_memory.unlink()
+
+    columns = {
+        column: (output[2 * position], output[2 * position + 1].astype(bool))
+        for position, column in enumerate(column_names)
+    }
+    return _decoded_columns_to_frame(columns, index)
+
+
+# ========================================CURSOR LOADING==========================================
+
+# Schema dtype -> storage of its preallocated column; categories store int32 codes
+_SCHEMA_STORAGE = {
+    "category": np.int32,
+    "datetime64[ms]": "datetime64[ms]",
+    "int32": np.int32,
+    "uint32": np.uint32,
+    "int64": np.int64,
+    "float64": np.float64,
+    "object": object,
+}
+
+# Integer schema dtypes and their nullable pandas counterparts
+_NULLABLE_INTEGERS = {"int32": "Int32", "uint32": "UInt32", "int64": "Int64"}
+
+
+def _integer_values(values, dtype):
+    """
+    values as an integer dtype and the mask of those it cannot hold
+    exactly: missing values, NaN, fractions, out of range numbers and
+    anything that is not a number.
+    """
+    numbers = np.asarray(values) if len(values) else np.zeros(0, dtype=np.int64)
+    if numbers.dtype.kind not in "iuf":
+        numbers = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy()
+        if numbers.dtype.kind not in "iuf":
+            numbers = numbers.astype(np.float64)
+    info = np.iinfo(dtype)
+    with np.errstate(invalid="ignore"):
+        # max + 1 is a power of two, so float values compare to it exactly
+        exact = (numbers >= info.min) & (numbers < info.max + 1)
+        if numbers.dtype.kind == "f":
+            exact &= numbers == np.floor(numbers)
+    return np.where(exact, numbers, 0).astype(dtype), ~exact
+
+
+def _fill_column(column, mask, start, values, dtype, lookup):
+    """
+    Write one batch of field values into a preallocated column from start.
+    """
+    stop = start + len(values)
+    if dtype == "category":
+        codes, uniques = pd.factorize(np.fromiter(values, dtype=object, count=len(values)))
+        ids = np.array([lookup.setdefault(value, len(lookup)) for value in uniques], dtype=np.int32)
+        # Missing values keep the -1 code
+        column[start:stop] = np.r_[ids, np.int32(-1)][codes]
+    elif dtype in _NULLABLE_INTEGERS:
+        column[start:stop], mask[start:stop] = _integer_values(values, column.dtype)
+    elif dtype == "datetime64[ms]":
+        dates = pd.DatetimeIndex(values)
+        if dates.tz is not None:
+            dates = dates.tz_convert(None)
+        column[start:stop] = dates.as_unit("ms").to_numpy()
+    elif dtype == "object":
+        column[start:stop] = np.fromiter(values, dtype=object, count=len(values))
+    else:
+        column[start:stop] = np.array(values, dtype=column.dtype)
+
+
+def load_cursor(cursor, schema, batch_size=50000):
+    """
+    Read documents, such as a Mongo cursor, into a DataFrame with one typed
+    column per schema field (field -> "category", "datetime64[ms]", "int32",
+    "uint32", "int64", "float64" or "object"). Documents are read batch_size
+    at a time into preallocated NumPy columns that double when full, so no
+    list of every document is ever built. Fields outside the schema are
+    dropped; integer columns with missing values become nullable.
+    """
+    capacity = batch_size
+    columns = {
+        field: np.empty(capacity, dtype=_SCHEMA_STORAGE[dtype]) for field, dtype in schema.items()
+    }
+    masks = {
+        field: np.zeros(capacity, dtype=bool)
+        for field, dtype in schema.items()
+        if dtype in _NULLABLE_INTEGERS
+    }
+    lookups = {field: {} for field, dtype in schema.items() if dtype == "category"}
+
+    iterator = iter(cursor)
+    rows = 0
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+
+        if rows + len(batch) > capacity:
+            # Double the columns; masks grow with False
+            capacity = max(2 * capacity, rows + len(batch))
+            for store, allocate in ((columns, np.empty), (masks, np.zeros)):
+                for field, column in store.items():
+                    grown = allocate(capacity, dtype=column.dtype)
+                    grown[:rows] = column[:rows]
+                    store[field] = grown
+
+        for field, dtype in schema.items():
+            values = [document.get(field) for document in batch]
+            _fill_column(columns[field], masks.get(field), rows, values, dtype, lookups.get(field))
+        rows += len(batch)
+
+    frame = {}
+    for field, dtype in schema.items():
+        column = columns[field][:rows]
+        if dtype == "category":
+            frame[field] = pd.Categorical.from_codes(column, categories=list(lookups[field]))
+        elif dtype in _NULLABLE_INTEGERS and masks[field][:rows].any():
+            frame[field] = pd.arrays.IntegerArray(column, masks[field][:rows])
+        else:
+            frame[field] = column
+
+    return pd.DataFrame(frame, columns=list(schema))
+
+
+def load_aggregate(collection, pipeline, schema, batch_size=50000):
+    """
+    Run an aggregation and load its cursor with load_cursor.
+    """
+    cursor = collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+    return load_cursor(cursor, schema, batch_size)
+
+
+# ========================================ABSENTEES & REAWAKEN==========================================
+
+
+def grab_reports_for_comparison(input_date, DIR_daily_reports):
+    all_files = os.listdir(DIR_daily_reports)
+    # Filter files that match the naming pattern
+    report_files = [
+        file
+        for file in all_files
+        if file.startswith("Daily Report for ") and file.endswith(".xlsx")
+    ]
+
+    # Extract dates from the report names and convert to datetime objects
+    report_dates = [
+        datetime.strptime(report.split(" ")[3], "%Y-%m-%d") for report in report_files
+    ]
+    str_report_dates = [date.strftime("%Y-%m-%d") for date in report_dates]
+    # Convert input_date to datetime object
+    input_datetime = datetime.strptime(input_date, "%Y-%m-%d")
+    # Convert each date in list_of_dates to datetime objects
+    date_objects = [datetime.strptime(date, "%Y-%m-%d") for date in str_report_dates]
+    # Find the last date before the input date in the list
+    last_date = max(date for date in date_objects if date < input_datetime)
+
+    # Convert last_date to string in the original format
+    last_date_str = last_date.strftime("%Y-%m-%d")
+    name_report_yesterday = next(
+        (date for date in report_files if last_date_str in date), None
+    )
+    name_report_today = next(
+        (date for date in report_files if input_date in date), None
+    )
+
+    report_yesterday = pd.read_excel(
+        DIR_daily_reports + "/" + name_report_yesterday, sheet_name="All Sensors"
+    )
+    report_today = pd.read_excel(
+        DIR_daily_reports + "/" + name_report_today, sheet_name="All Sensors"
+    )
+
+    report_yesterday["EUI"] = report_yesterday["EUI"].str.strip()
+    report_today["EUI"] = report_today["EUI"].str.strip()
+
+    # Yesterday's awake EUIs
+    abs0_repy = (
+        report_yesterday[
+            report_yesterday["Days since sensor sent its Last message (Days)"] == "0"
+        ]["EUI"]
+        .str.strip()
+        .tolist()
+    )
+    # Yesterday's 1 day absentees
+    abs1_repy = (
+        report_yesterday[
+            report_yesterday["Days since sensor sent its Last message (Days)"] == "1"
+        ]["EUI"]
+        .str.strip()
+        .tolist()
+    )
+
+    # Today's awake EUIs
+    abs0_rept = (
+        report_today[
+            report_today["Days since sensor sent its Last message (Days)"] == "0"
+        ]["EUI"]
+        .str.strip()
+        .tolist()
+    )
+
+    # Today's 1 day absentees
+    abs1_rept = (
+        report_today[
+            report_today["Days since sensor sent its Last message (Days)"] == "1"
+        ]["EUI"]
+        .str.strip()
+        .tolist()
+    )
+
+    # Comparison: New 1 day absentees
+    sleepies_eui = [eui for eui in abs1_rept if eui in abs0_repy]
+    new_sleepies = len(sleepies_eui)
+
+    # Comparison: EUIs that woke up
+    woken_up_eui = [eui for eui in abs0_rept if eui in abs1_repy]
+    new_woken_up = len(woken_up_eui)
+
+    return new_sleepies, new_woken_up, sleepies_eui, woken_up_eui
+
+
+# ****************************************************************************************************
 
 # ----------------------------------------------------------------------------------------------------
 # Functions for data extractions through Mongo Pipelines
 # ----------------------------------------------------------------------------------------------------
 
 
+# Columns of the start/end date lookups
+START_END_SCHEMA = {"_id": "object", "start_date": "datetime64[ms]", "end_date": "datetime64[ms]"}
+START_END_BATCH_SCHEMA = {
+    "eui": "category",
+    "start_date": "datetime64[ms]",
+    "end_date": "datetime64[ms]",
+}
+
+# Days covered by the fixed length selectors
+SELECTOR_DAYS = {"twentyfourhours": 1, "weekly": 7, "fortnightly": 15}
+
+# Calendar months covered by the month based selectors
+SELECTOR_MONTHS = {"monthly": 1, "3_month": 3}
+
+
+def _selector_window_ms(selector_value, date):
+    """
+    Length in milliseconds of the window a selector covers before date.
+    Month based windows use relativedelta, which takes care of variable
+    month lengths.
+    """
+    if selector_value in SELECTOR_DAYS:
+        return 86400000 * SELECTOR_DAYS[selector_value]  # // 86400000 milliseconds in a day
+    if selector_value in SELECTOR_MONTHS:
+        given_date = datetime.strptime(date.strftime("%Y-%m-%d"), "%Y-%m-%d")
+        months_before = given_date - relativedelta(months=SELECTOR_MONTHS[selector_value])
+        return 86400000 * (given_date - months_before).days
+    raise ValueError(
+        "Unknown selector {}, use one of {}".format(
+            selector_value, list(SELECTOR_DAYS) + list(SELECTOR_MONTHS)
+        )
+    )
+
+
+def _start_end_dates_pipeline(date, mili_sec_in_days, eui_filter=None):
+    """
+    Last uplink date and derived window of every EUI, in one $group.
+    """
+    match = {"cmd": "rx", "createdDate": {"$lte": date}}
+    if eui_filter is not None:
+        match["eui"] = eui_filter
+    return [
+        {"$match": match},
+        {"$group": {"_id": "$eui", "maxDate": {"$max": "$createdDate"}}},
+        {
+            "$project": {
+                "_id": 0,
+                "eui": "$_id",
+                "start_date": {"$subtract": ["$maxDate", mili_sec_in_days]},
+                "end_date": "$maxDate",
+            }
+        },
+    ]
+
+
+def get_start_end_dates(conn, date, selector_value, database, collection, euis=None):
+    """
+    Batch get_start_end_date_active: the window of every EUI in euis (all
+    EUIs when None) from one grouped aggregation per store. On St. Pete,
+    EUIs without uplinks in the active store are looked up in the archive
+    in one more aggregation; the archive column tells which store answered.
+    """
+    mili_sec_in_days = _selector_window_ms(selector_value, date)
+
+    eui_filter = None if euis is None else {"$in": list(euis)}
+    pipeline = _start_end_dates_pipeline(date, mili_sec_in_days, eui_filter)
+    collection = conn[database][collection]
+    df = load_aggregate(collection, pipeline, START_END_BATCH_SCHEMA)
+    df["archive"] = False
+
+    if database == "conurets_smart_park_st_pete":
+        found = set(df["eui"])
+        if euis is None:
+            eui_filter = {"$nin": list(found)}
+        else:
+            eui_filter = {"$in": [eui for eui in euis if eui not in found]}
+
+        if euis is None or eui_filter["$in"]:
+            pipeline = _start_end_dates_pipeline(date, mili_sec_in_days, eui_filter)
+            collection = conn.conurets_smart_park_st_pete_archive.cd_device_data_log_archive
+            archived = load_aggregate(collection, pipeline, START_END_BATCH_SCHEMA)
+            archived["archive"] = True
+            df = pd.concat([df, archived], ignore_index=True)
+
+    print("retrieved collection successfully!!!")
+
+    # Lexical EUI order whether eui is still categorical or object after a concat
+    return df.sort_values("eui", key=lambda eui: eui.astype(str), ignore_index=True)
+
+
 def get_start_end_date_active(conn, eui, date, selector_value, database, collection):
     """
     Pipeline credits: Hira Ahmed
     """
 
-    if selector_value == "twentyfourhours":
-        mili_sec_in_days = 86400000  # // 86400000 milliseconds in a day
-    elif selector_value == "weekly":
-        mili_sec_in_days = 86400000 * 7  # // 86400000 milliseconds in 7 day
-    elif selector_value == "fortnightly":
-        mili_sec_in_days = 86400000 * 15  # // 86400000 milliseconds in 15 day
-    elif selector_value == "monthly":
-        # # Convert the input date string to a datetime object
-        # Format the datetime object as a string in the desired format
-        temp_given_date = date.strftime("%Y-%m-%d")
-        temp_given_date = datetime.strptime(temp_given_date, "%Y-%m-%d")
-        # Calculate 1 month before using relativedelta, which takes care of variable month lengths
-        one_month_before = temp_given_date - relativedelta(months=1)
-        # # Determine the number of days in that month
-        days_in_previous_month = (temp_given_date - one_month_before).days
-        # print("days before one month......", str(int(days_in_previous_month)))
-        # Calculate 1 month before using relativedelta, which takes care of variable month lengths
-        mili_sec_in_days = 86400000 * int(
-            days_in_previous_month
-        )  # // 86400000 milliseconds in one month
-    elif selector_value == "3_month":
-        # # Convert the input date string to a datetime object
-        # Format the datetime object as a string in the desired format
-        temp_given_date = date.strftime("%Y-%m-%d")
-        temp_given_date = datetime.strptime(temp_given_date, "%Y-%m-%d")
-        # Calculate 1 month before using relativedelta, which takes care of variable month lengths
-        three_month_before = temp_given_date - relativedelta(months=3)
-        # # Determine the number of days in that month
-        days_in_previous_month = (temp_given_date - three_month_before).days
-        # print("days before one month......", str(int(days_in_previous_month)))
-        # Calculate 1 month before using relativedelta, which takes care of variable month lengths
-        mili_sec_in_days = 86400000 * int(
-            days_in_previous_month
-        )  # // 86400000 milliseconds in one month
+    mili_sec_in_days = _selector_window_ms(selector_value, date)
     db = conn[database]
     collection = db[collection]
     # print()
@@ -1017,7 +2879,7 @@ def get_start_end_date_active(conn, eui, date, selector_value, database, collect
         },
     ]
     try:
-        df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+        df = load_aggregate(collection, pipeline, START_END_SCHEMA)
     except:
         print("Cannot fetch the dates from active db...")
 
@@ -1063,7 +2925,7 @@ def get_start_end_date_archive(conn, eui, date, mili_sec_in_days):
         },
     ]
     try:
-        df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+        df = load_aggregate(collection, pipeline, START_END_SCHEMA)
     except:
         print("Cannot fetch the dates from archieve db...")
     try:
@@ -1076,6 +2938,17 @@ def get_start_end_date_archive(conn, eui, date, mili_sec_in_days):
     return df
 
 
+# Uplink fields of the RSSI history of a sensor; fcnt is a 32 bit unsigned counter
+RSSI_SCHEMA = {
+    "createdDate": "datetime64[ms]",
+    "rssi": "float64",
+    "snr": "float64",
+    "fcnt": "uint32",
+    "data": "object",
+}
+RSSI_DOCUMENT_SCHEMA = dict({"_id": "object", "eui": "category"}, **RSSI_SCHEMA)
+
+
 def get_the_rssi_before_absentees_active(conn, eui, start_date, end_date, database, collection):
     """
     Pipeline credits: Hira Ahmed
@@ -1104,7 +2977,7 @@ def get_the_rssi_before_absentees_active(conn, eui, start_date, end_date, databa
         },
     ]
     try:
-        df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+        df = load_aggregate(collection, pipeline, RSSI_DOCUMENT_SCHEMA)
     except:
         print("Cannot fetch the rssi etc from active db...")
 
@@ -1139,7 +3012,7 @@ def get_the_rssi_before_absentees_archive(conn, eui, start_date, end_date):
         },
     ]
     try:
-        df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+        df = load_aggregate(collection, pipeline, RSSI_DOCUMENT_SCHEMA)
     except:
         print("Cannot fetch the rssi etc from achieve db...")
     try:
@@ -1151,288 +3024,194 @@ def get_the_rssi_before_absentees_archive(conn, eui, start_date, end_date):
     return df
 
 
-# ========================================GATEWAY==========================================
+def rssi_history_pipeline(requests):
+    """
+    RSSI history of many (eui, start_date, end_date) requests in one query,
+    sorted by eui, then createdDate. EUIs sharing a window share one $in.
+    """
+    windows = {}
+    for eui, start_date, end_date in requests:
+        windows.setdefault((start_date, end_date), []).append(eui)
+    clauses = [
+        {"eui": {"$in": euis}, "createdDate": {"$gte": start_date, "$lte": end_date}}
+        for (start_date, end_date), euis in windows.items()
+    ]
+    project = {field: "$" + field for field in RSSI_SCHEMA}
+    project.update({"_id": 0, "eui": "$eui"})
+    return [
+        {"$match": {"cmd": "rx", "$or": clauses}},
+        {"$sort": {"eui": 1, "createdDate": 1}},
+        {"$project": project},
+    ]
 
 
-def agg_gw_active(conn, start_time_obj, end_time_obj, database, collection):
+def _split_by_eui(documents, schema=RSSI_SCHEMA):
     """
-    Pipeline Credits: Hira Ahmed
+    Split documents sorted by eui into (eui, DataFrame) pairs. They are
+    loaded once with load_cursor and every EUI gets its slice of the rows.
     """
-    db = conn[database]
-    collection = db[collection]
-
-    if database == "conurets_smart_park_st_pete":
-        pipeline = [
-            {
-                "$match": {
-                    "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
-                    "cmd": "gw",
-                }
-            },
-            {"$unwind": "$gwsBean"},
-            {
-                "$project": {
-                    "eui": "$eui",
-                    "ts": "$ts",
-                    "gwsTs": "$gwsBean.gwsTs",
-                    "gwEui": "$gwsBean.gwEui",
-                }
-            },
-            {
-                "$match": {
-                    "$expr": {"$eq": ["$ts", "$gwsTs"]},
-                    "gwEui": {
-                        "$in": ["000800FFFF4A6627", "000800FFFF4B348D", "000800FFFF4B348E"]
-                    },
-                }
-            },
-            {"$group": {"_id": "$gwEui", "count": {"$sum": 1}}},
+    df = load_cursor(documents, dict({"eui": "category"}, **schema))
+    if df.empty:
+        return
+    codes = df["eui"].cat.codes.to_numpy()
+    bounds = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1], True])
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        yield df["eui"].iat[start], df.iloc[start:stop, 1:].reset_index(drop=True)
+
+
+def get_rssi_histories(
+    conn, requests, database, collection, archive_boundary=None, batch_size=10000
+):
+    """
+    Batch get_the_rssi_before_absentees_active: the rssi, snr, fcnt and data
+    history of many (eui, start_date, end_date) requests, with one query
+    per store. On St. Pete the archive is queried at the same time for the
+    requests starting before archive_boundary (st_pete_archive_boundary
+    when not given), each store clipped to its side of the boundary.
+    Returns a dict of eui -> DataFrame sorted by createdDate.
+    """
+    requests = list(requests)
+    stores = [(conn[database][collection], requests)]
+    if database == ST_PETE_DATABASE and archive_boundary is None:
+        archive_boundary = st_pete_archive_boundary(conn)
+    if database == ST_PETE_DATABASE and archive_boundary is not None:
+        # Dates are stored to the millisecond
+        archive_end = archive_boundary - timedelta(milliseconds=1)
+        active = [
+            (eui, max(start_date, archive_boundary), end_date)
+            for eui, start_date, end_date in requests
+            if end_date >= archive_boundary
         ]
-        df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
-        archive_flag = False
-        if df.empty:
-            print("Not found.............")
-            df = agg_gw_archive(conn, start_time_obj, end_time_obj)
-            archive_flag = True
-        else:
-            archive_flag = False
-        print("retrieved collection successfully!!!")
-
-        return df, archive_flag
-    else:
-        pipeline = [
-            {
-                "$match": {
-                    "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
-                    "cmd": "gw",
-                }
-            },
-            {"$unwind": "$gwsBean"},
-            {
-                "$project": {
-                    "eui": "$eui",
-                    "ts": "$ts",
-                    "gwsTs": "$gwsBean.gwsTs",
-                    "gwEui": "$gwsBean.gwEui",
-                }
-            },
-            {"$match": {"$expr": {"$eq": ["$ts", "$gwsTs"]}}},
-            {"$group": {"_id": "$gwEui", "count": {"$sum": 1}}},
+        archived = [
+            (eui, start_date, min(end_date, archive_end))
+            for eui, start_date, end_date in requests
+            if start_date < archive_boundary
         ]
-        df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+        stores = [(conn[database][collection], active), (_archive_collection(conn), archived)]
 
-        return df
+    def fetch(store_collection, store_requests):
+        if not store_requests:
+            return {}
+        cursor = store_collection.aggregate(
+            rssi_history_pipeline(store_requests), allowDiskUse=True, batchSize=batch_size
+        )
+        return dict(_split_by_eui(cursor))
+
+    with ThreadPoolExecutor(max_workers=len(stores)) as pool:
+        parts = list(pool.map(lambda store: fetch(*store), stores))
+
+    histories = parts[0]
+    for part in parts[1:]:
+        for eui, history in part.items():
+            if eui in histories:
+                history = pd.concat([history, histories[eui]], ignore_index=True)
+                history = history.sort_values("createdDate", kind="stable", ignore_index=True)
+            histories[eui] = history
+    print("retrieved collection successfully!!!")
 
+    return histories
 
-def agg_gw_archive(conn, start_time_obj, end_time_obj):
-    """
-    Pipeline Credits: Hira Ahmed
-    """
-    db = conn.conurets_smart_park_st_pete_archive
-    collection = db["cd_device_data_log_archive"]
 
-    pipeline = [
-        {
-            "$match": {
-                "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
-                "cmd": "gw",
-            }
-        },
-        {"$unwind": "$gwsBean"},
-        {
-            "$project": {
-                "eui": "$eui",
-                "ts": "$ts",
-                "gwsTs": "$gwsBean.gwsTs",
-                "gwEui": "$gwsBean.gwEui",
-            }
-        },
-        {
-            "$match": {
-                "$expr": {"$eq": ["$ts", "$gwsTs"]},
-                "gwEui": {
-                    "$in": ["000800FFFF4A6627", "000800FFFF4B348D", "000800FFFF4B348E"]
-                },
-            }
-        },
-        {"$group": {"_id": "$gwEui", "count": {"$sum": 1}}},
-    ]
-    df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+# ========================================GATEWAY==========================================
 
-    print("retrieved collection successfully!!!")
-    return df
 
-# ========================================BATTERY STATE==========================================
+# Gateways whose receptions count on St. Pete
+ST_PETE_GATEWAYS = ["000800FFFF4A6627", "000800FFFF4B348D", "000800FFFF4B348E"]
 
 
-def battery_state_active(conn, start_time_obj, end_time_obj, database, collection):
-    """
-    Pipeline Credits: Hira Ahmed
-    """
+# Columns of the gateway pipelines
+GW_SCHEMA = {"_id": "category", "count": "int32"}
+GW_DOWNLOAD_SCHEMA = {
+    "_id": "object",
+    "eui": "category",
+    "createdDate": "datetime64[ms]",
+    "gwEui": "category",
+}
 
-    db = conn[database]
-    collection = db[collection]
 
-    pipeline = [
+def _gw_reception_stages(start_time_obj, end_time_obj, gateways=None, fields=("eui",)):
+    """
+    Receptions of gw uplinks in the window by the gateway that timestamped
+    them, optionally only by the given gateways.
+    """
+    reception = {"$expr": {"$eq": ["$ts", "$gwsTs"]}}
+    if gateways is not None:
+        reception["gwEui"] = {"$in": list(gateways)}
+    project = {field: "$" + field for field in fields}
+    project.update({"ts": "$ts", "gwsTs": "$gwsBean.gwsTs", "gwEui": "$gwsBean.gwEui"})
+    return [
         {
             "$match": {
                 "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
                 "cmd": "gw",
-                "data": {"$exists": "true", "$ne": ""},
-            }
-        },
-        {"$project": {"eui": 1, "data": {"$ifNull": ["$data", ""]}, "createdDate": 1}},
-        {"$sort": {"createdDate": -1}},
-        {
-            "$addFields": {
-                "BatteryState": {
-                    "$switch": {
-                        "branches": [
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["0", "1", "2", "3", "8", "9", "a", "b"],
-                                    ]
-                                },
-                                "then": "Healthy",
-                            },
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["4", "5", "6", "7", "c", "d", "e", "f"],
-                                    ]
-                                },
-                                "then": "Weak",
-                            },
-                        ],
-                        "default": "Unknown",
-                    }
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": "$eui",
-                "BatteryState": {"$first": "$BatteryState"},
-                "CreatedDate": {"$first": "$createdDate"},
-            }
-        },
-        {
-            "$group": {
-                "_id": "$BatteryState",
-                "total": {"$sum": 1},
-                "euis": {"$push": "$_id"},
             }
         },
+        {"$unwind": "$gwsBean"},
+        {"$project": project},
+        {"$match": reception},
     ]
 
-    df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
 
-    if database == "conurets_smart_park_st_pete":
-        archive_flag = False
-        if df.empty:
-            print("Not found.............")
-            df = battery_state_archive(conn, start_time_obj, end_time_obj)
-            archive_flag = True
-
-        else:
-            archive_flag = False
-            df = df.rename(columns={"_id": "battery_status"})
+def gw_pipeline(start_time_obj, end_time_obj, gateways=None):
+    """
+    Reception count per gateway.
+    """
+    return _gw_reception_stages(start_time_obj, end_time_obj, gateways) + [
+        {"$group": {"_id": "$gwEui", "count": {"$sum": 1}}},
+    ]
 
-        print("retrieved collection successfully!!!")
 
-        return df, archive_flag
-    else:
-        df = df.rename(columns={"_id": "battery_status"})
-        print("retrieved collection successfully!!!")
-        return df
+def gw_download_pipeline(start_time_obj, end_time_obj, gateways=None):
+    """
+    One row per reception: eui, createdDate and gwEui.
+    """
+    stages = _gw_reception_stages(
+        start_time_obj, end_time_obj, gateways, fields=("eui", "createdDate")
+    )
+    return stages + [
+        {"$project": {"eui": "$eui", "createdDate": "$createdDate", "gwEui": "$gwEui"}},
+    ]
 
 
-def battery_state_archive(conn, start_time_obj, end_time_obj):
+def agg_gw_active(conn, start_time_obj, end_time_obj, database, collection, archive_boundary=None):
     """
     Pipeline Credits: Hira Ahmed
     """
+    return _routed_active(
+        conn, "gateway", start_time_obj, end_time_obj, database, collection, archive_boundary
+    )
 
+
+def agg_gw_archive(conn, start_time_obj, end_time_obj):
+    """
+    Pipeline Credits: Hira Ahmed
+    """
     db = conn.conurets_smart_park_st_pete_archive
     collection = db["cd_device_data_log_archive"]
 
-    pipeline = [
-        {
-            "$match": {
-                "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
-                "cmd": "gw",
-                "data": {"$exists": "true", "$ne": ""},
-            }
-        },
-        {"$project": {"eui": 1, "data": {"$ifNull": ["$data", ""]}, "createdDate": 1}},
-        {"$sort": {"createdDate": -1}},
-        {
-            "$addFields": {
-                "BatteryState": {
-                    "$switch": {
-                        "branches": [
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["0", "1", "2", "3", "8", "9", "a", "b"],
-                                    ]
-                                },
-                                "then": "Healthy",
-                            },
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["4", "5", "6", "7", "c", "d", "e", "f"],
-                                    ]
-                                },
-                                "then": "Weak",
-                            },
-                        ],
-                        "default": "Unknown",
-                    }
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": "$eui",
-                "BatteryState": {"$first": "$BatteryState"},
-                "CreatedDate": {"$first": "$createdDate"},
-            }
-        },
-        {
-            "$group": {
-                "_id": "$BatteryState",
-                "total": {"$sum": 1},
-                "euis": {"$push": "$_id"},
-            }
-        },
-    ]
+    pipeline = gw_pipeline(start_time_obj, end_time_obj, ST_PETE_GATEWAYS)
+    df = load_aggregate(collection, pipeline, GW_SCHEMA)
 
-    df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
     print("retrieved collection successfully!!!")
-    df = df.rename(columns={"_id": "battery_status"})
     return df
 
-
-############# Battery state different Format for Downloading Data ##############################
-
 # ========================================BATTERY STATE==========================================
 
 
-def battery_state_download_active(conn, start_time_obj, end_time_obj, database, collection):
-    """
-    Pipeline Credits: Hira Ahmed
-    """
+# Columns of the battery pipelines
+BATTERY_SCHEMA = {"_id": "category", "total": "int32", "euis": "object"}
+BATTERY_DOWNLOAD_SCHEMA = {
+    "_id": "category",
+    "BatteryState": "category",
+    "CreatedDate": "datetime64[ms]",
+}
 
-    db = conn[database]
-    collection = db[collection]
 
-    pipeline = [
+def battery_download_pipeline(start_time_obj, end_time_obj):
+    """
+    Latest battery state of every EUI in the window.
+    """
+    return [
         {
             "$match": {
                 "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
@@ -1442,35 +3221,7 @@ def battery_state_download_active(conn, start_time_obj, end_time_obj, database,
         },
         {"$project": {"eui": 1, "data": {"$ifNull": ["$data", ""]}, "createdDate": 1}},
         {"$sort": {"createdDate": -1}},
-        {
-            "$addFields": {
-                "BatteryState": {
-                    "$switch": {
-                        "branches": [
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["0", "1", "2", "3", "8", "9", "a", "b"],
-                                    ]
-                                },
-                                "then": "Healthy",
-                            },
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["4", "5", "6", "7", "c", "d", "e", "f"],
-                                    ]
-                                },
-                                "then": "Weak",
-                            },
-                        ],
-                        "default": "Unknown",
-                    }
-                }
-            }
-        },
+        {"$addFields": {"BatteryState": _header_switch(2, ("Healthy", "Weak"))}},
         {
             "$group": {
                 "_id": "$eui",
@@ -1480,26 +3231,69 @@ def battery_state_download_active(conn, start_time_obj, end_time_obj, database,
         },
     ]
 
-    df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
 
-    if database == "conurets_smart_park_st_pete":
-        archive_flag = False
-        if df.empty:
-            print("Not found.............")
-            df = battery_state_download_archive(conn, start_time_obj, end_time_obj)
-            archive_flag = True
+def battery_pipeline(start_time_obj, end_time_obj):
+    """
+    EUIs and their count per latest battery state.
+    """
+    return battery_download_pipeline(start_time_obj, end_time_obj) + [
+        {
+            "$group": {
+                "_id": "$BatteryState",
+                "total": {"$sum": 1},
+                "euis": {"$push": "$_id"},
+            }
+        },
+    ]
 
-        else:
-            archive_flag = False
-            df = df.rename(columns={"_id": "battery_status"})
 
-        print("retrieved collection successfully!!!")
+def battery_state_active(
+    conn, start_time_obj, end_time_obj, database, collection, archive_boundary=None
+):
+    """
+    Pipeline Credits: Hira Ahmed
+    """
+    return _routed_active(
+        conn, "battery", start_time_obj, end_time_obj, database, collection, archive_boundary
+    )
 
-        return df, archive_flag
-    else:
-        print("retrieved collection successfully!!!")
-        df = df.rename(columns={"_id": "battery_status"})
-        return df
+
+def battery_state_archive(conn, start_time_obj, end_time_obj):
+    """
+    Pipeline Credits: Hira Ahmed
+    """
+
+    db = conn.conurets_smart_park_st_pete_archive
+    collection = db["cd_device_data_log_archive"]
+
+    pipeline = battery_pipeline(start_time_obj, end_time_obj)
+
+    df = load_aggregate(collection, pipeline, BATTERY_SCHEMA)
+    print("retrieved collection successfully!!!")
+    df = df.rename(columns={"_id": "battery_status"})
+    return df
+
+
+############# Battery state different Format for Downloading Data ##############################
+
+# ========================================BATTERY STATE==========================================
+
+
+def battery_state_download_active(
+    conn, start_time_obj, end_time_obj, database, collection, archive_boundary=None
+):
+    """
+    Pipeline Credits: Hira Ahmed
+    """
+    return _routed_active(
+        conn,
+        "battery_download",
+        start_time_obj,
+        end_time_obj,
+        database,
+        collection,
+        archive_boundary,
+    )
 
 
 def battery_state_download_archive(conn, start_time_obj, end_time_obj):
@@ -1510,55 +3304,9 @@ def battery_state_download_archive(conn, start_time_obj, end_time_obj):
     db = conn.conurets_smart_park_st_pete_archive
     collection = db["cd_device_data_log_archive"]
 
-    pipeline = [
-        {
-            "$match": {
-                "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
-                "cmd": "gw",
-                "data": {"$exists": "true", "$ne": ""},
-            }
-        },
-        {"$project": {"eui": 1, "data": {"$ifNull": ["$data", ""]}, "createdDate": 1}},
-        {"$sort": {"createdDate": -1}},
-        {
-            "$addFields": {
-                "BatteryState": {
-                    "$switch": {
-                        "branches": [
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["0", "1", "2", "3", "8", "9", "a", "b"],
-                                    ]
-                                },
-                                "then": "Healthy",
-                            },
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["4", "5", "6", "7", "c", "d", "e", "f"],
-                                    ]
-                                },
-                                "then": "Weak",
-                            },
-                        ],
-                        "default": "Unknown",
-                    }
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": "$eui",
-                "BatteryState": {"$first": "$BatteryState"},
-                "CreatedDate": {"$first": "$createdDate"},
-            }
-        },
-    ]
+    pipeline = battery_download_pipeline(start_time_obj, end_time_obj)
 
-    df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+    df = load_aggregate(collection, pipeline, BATTERY_DOWNLOAD_SCHEMA)
     print("retrieved collection successfully!!!")
     df = df.rename(columns={"_id": "battery_status"})
     return df
@@ -1569,77 +3317,24 @@ def battery_state_download_archive(conn, start_time_obj, end_time_obj):
 # ========================================GATEWAY==========================================
 
 
-def agg_gw_download_active(conn, start_time_obj, end_time_obj, database, collection):
+def agg_gw_download_active(
+    conn, start_time_obj, end_time_obj, database, collection, archive_boundary=None
+):
     """
     Pipeline Credits: Hira Ahmed
     """
-    db = conn[database]
-    collection = db[collection]
-
-    if database == "conurets_smart_park_st_pete":
-        pipeline = [
-            {
-                "$match": {
-                    "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
-                    "cmd": "gw",
-                }
-            },
-            {"$unwind": "$gwsBean"},
-            {
-                "$project": {
-                    "eui": "$eui",
-                    "createdDate": "$createdDate",
-                    "ts": "$ts",
-                    "gwsTs": "$gwsBean.gwsTs",
-                    "gwEui": "$gwsBean.gwEui",
-                }
-            },
-            {
-                "$match": {
-                    "$expr": {"$eq": ["$ts", "$gwsTs"]},
-                    "gwEui": {
-                        "$in": ["000800FFFF4A6627", "000800FFFF4B348D", "000800FFFF4B348E"]
-                    },
-                }
-            },
-            {"$project": {"eui": "$eui", "createdDate": "$createdDate", "gwEui": "$gwEui"}},
-        ]
-        df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
-        archive_flag = False
-        if df.empty:
-            print("Not found.............")
-            df = agg_gw_download_archive(conn, start_time_obj, end_time_obj)
-            archive_flag = True
-        else:
-            archive_flag = False
-        print("retrieved collection successfully!!!")
-
-        return df, archive_flag
-    else:
-        pipeline = [
-            {
-                "$match": {
-                    "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
-                    "cmd": "gw",
-                }
-            },
-            {"$unwind": "$gwsBean"},
-            {
-                "$project": {
-                    "eui": "$eui",
-                    "createdDate": "$createdDate",
-                    "ts": "$ts",
-                    "gwsTs": "$gwsBean.gwsTs",
-                    "gwEui": "$gwsBean.gwEui",
-                }
-            },
-            {"$match": {"$expr": {"$eq": ["$ts", "$gwsTs"]}}},
-            {"$project": {"eui": "$eui", "createdDate": "$createdDate", "gwEui": "$gwEui"}},
-        ]
-        df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
-        print("retrieved collection successfully!!!")
-        df = df.rename(columns={"_id": "battery_status"})
-        return df
+    result = _routed_active(
+        conn,
+        "gateway_download",
+        start_time_obj,
+        end_time_obj,
+        database,
+        collection,
+        archive_boundary,
+    )
+    if database == ST_PETE_DATABASE:
+        return result
+    return result.rename(columns={"_id": "battery_status"})
 
 
 def agg_gw_download_archive(conn, start_time_obj, end_time_obj):
@@ -1649,34 +3344,8 @@ def agg_gw_download_archive(conn, start_time_obj, end_time_obj):
     db = conn.conurets_smart_park_st_pete_archive
     collection = db["cd_device_data_log_archive"]
 
-    pipeline = [
-        {
-            "$match": {
-                "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
-                "cmd": "gw",
-            }
-        },
-        {"$unwind": "$gwsBean"},
-        {
-            "$project": {
-                "eui": "$eui",
-                "createdDate": "$createdDate",
-                "ts": "$ts",
-                "gwsTs": "$gwsBean.gwsTs",
-                "gwEui": "$gwsBean.gwEui",
-            }
-        },
-        {
-            "$match": {
-                "$expr": {"$eq": ["$ts", "$gwsTs"]},
-                "gwEui": {
-                    "$in": ["000800FFFF4A6627", "000800FFFF4B348D", "000800FFFF4B348E"]
-                },
-            }
-        },
-        {"$project": {"eui": "$eui", "createdDate": "$createdDate", "gwEui": "$gwEui"}},
-    ]
-    df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+    pipeline = gw_download_pipeline(start_time_obj, end_time_obj, ST_PETE_GATEWAYS)
+    df = load_aggregate(collection, pipeline, GW_DOWNLOAD_SCHEMA)
     print("retrieved collection successfully!!!")
     return df
 
@@ -1686,15 +3355,15 @@ def agg_gw_download_archive(conn, start_time_obj, end_time_obj):
 # ========================================TOTAL OCCUPANCY==========================================
 
 
-def total_occupied_active(conn, start_time_obj, end_time_obj, database, collection):
-    """
-    Pipeline Credits: Hira Ahmed
-    """
+# Columns of the occupied count pipeline
+OCCUPIED_SCHEMA = {"_id": "category", "count": "int32"}
 
-    db = conn[database]
-    collection = db[collection]
 
-    pipeline = [
+def occupied_pipeline(start_time_obj, end_time_obj):
+    """
+    Count of info frames reporting an occupied bay.
+    """
+    return [
         {
             "$match": {
                 "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
@@ -1705,59 +3374,21 @@ def total_occupied_active(conn, start_time_obj, end_time_obj, database, collecti
         {"$project": {"eui": 1, "data": {"$ifNull": ["$data", ""]}}},
         {"$addFields": {"secondByte_string": {"$substr": ["$data", 1, 1]}}},
         {"$match": {"secondByte_string": "0"}},
-        {
-            "$addFields": {
-                "OccupancyStatus": {
-                    "$switch": {
-                        "branches": [
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["0", "1", "2", "3", "4", "5", "6", "7"],
-                                    ]
-                                },
-                                "then": "Unoccupied",
-                            },
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["8", "9", "a", "b", "c", "d", "e", "f"],
-                                    ]
-                                },
-                                "then": "Occupied",
-                            },
-                        ],
-                        "default": "Unknown",
-                    }
-                }
-            }
-        },
+        {"$addFields": {"OccupancyStatus": _header_switch(3, ("Unoccupied", "Occupied"))}},
         {"$group": {"_id": "$OccupancyStatus", "count": {"$sum": 1}}},
         {"$match": {"_id": "Occupied"}},
     ]
 
-    df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
-
-    if database == "conurets_smart_park_st_pete":
-        archive_flag = False
-        if df.empty:
-            print("Not found.............")
-            occupancy_events = total_occupied_archive(conn, start_time_obj, end_time_obj)
-            archive_flag = True
-
-        else:
-            archive_flag = False
-            occupancy_events = int(df["count"].iloc[0])
-
-        print("retrieved collection successfully!!!")
 
-        return occupancy_events, archive_flag
-    else:
-        print("retrieved collection successfully!!!")
-        occupancy_events = int(df["count"].iloc[0])
-        return occupancy_events
+def total_occupied_active(
+    conn, start_time_obj, end_time_obj, database, collection, archive_boundary=None
+):
+    """
+    Pipeline Credits: Hira Ahmed
+    """
+    return _routed_active(
+        conn, "occupied", start_time_obj, end_time_obj, database, collection, archive_boundary
+    )
 
 
 def total_occupied_archive(conn, start_time_obj, end_time_obj):
@@ -1768,51 +3399,9 @@ def total_occupied_archive(conn, start_time_obj, end_time_obj):
     db = conn.conurets_smart_park_st_pete_archive
     collection = db["cd_device_data_log_archive"]
 
-    pipeline = [
-        {
-            "$match": {
-                "createdDate": {"$gte": start_time_obj, "$lte": end_time_obj},
-                "cmd": "gw",
-                "data": {"$exists": "true", "$ne": ""},
-            }
-        },
-        {"$project": {"eui": 1, "data": {"$ifNull": ["$data", ""]}}},
-        {"$addFields": {"secondByte_string": {"$substr": ["$data", 1, 1]}}},
-        {"$match": {"secondByte_string": "0"}},
-        {
-            "$addFields": {
-                "OccupancyStatus": {
-                    "$switch": {
-                        "branches": [
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["0", "1", "2", "3", "4", "5", "6", "7"],
-                                    ]
-                                },
-                                "then": "Unoccupied",
-                            },
-                            {
-                                "case": {
-                                    "$in": [
-                                        {"$substrCP": ["$data", 0, 1]},
-                                        ["8", "9", "a", "b", "c", "d", "e", "f"],
-                                    ]
-                                },
-                                "then": "Occupied",
-                            },
-                        ],
-                        "default": "Unknown",
-                    }
-                }
-            }
-        },
-        {"$group": {"_id": "$OccupancyStatus", "count": {"$sum": 1}}},
-        {"$match": {"_id": "Occupied"}},
-    ]
+    pipeline = occupied_pipeline(start_time_obj, end_time_obj)
 
-    df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+    df = load_aggregate(collection, pipeline, OCCUPIED_SCHEMA)
 
     print("retrieved collection successfully!!!")
 
@@ -1821,4 +3410,253 @@ def total_occupied_archive(conn, start_time_obj, end_time_obj):
     return occupancy_events
 
 
+# ========================================ACTIVE / ARCHIVE ROUTER==========================================
+
+ST_PETE_DATABASE = "conurets_smart_park_st_pete"
+
+
+def _archive_collection(conn):
+    return conn.conurets_smart_park_st_pete_archive["cd_device_data_log_archive"]
+
+
+def st_pete_archive_boundary(conn):
+    """
+    First millisecond after the latest uplink of the St. Pete archive:
+    uplinks before it are read from the archive, the others from the
+    active store. None while the archive is empty.
+    """
+    latest = _archive_collection(conn).find_one({}, {"createdDate": 1}, sort=[("createdDate", -1)])
+    if latest is None:
+        return None
+    return latest["createdDate"] + timedelta(milliseconds=1)
+
+
+def _concat_parts(parts):
+    """
+    Rows of every store part; the first part, with its schema columns, when
+    none has rows.
+    """
+    rows = [part for part in parts if not part.empty]
+    return pd.concat(rows, ignore_index=True) if rows else parts[0]
+
+
+def _sum_gateway_counts(parts):
+    """
+    Reception counts of both stores added up per gateway.
+    """
+    df = _concat_parts(parts)
+    if df.empty:
+        return df
+    return df.groupby("_id", as_index=False, sort=False, observed=True)["count"].sum()
+
+
+def _latest_battery(parts):
+    """
+    Latest battery state of every EUI across both stores.
+    """
+    df = _concat_parts(parts)
+    if df.empty:
+        return df
+    df = df.sort_values("CreatedDate", ascending=False, kind="stable")
+    df = df.drop_duplicates("_id").reset_index(drop=True)
+    return df.rename(columns={"_id": "battery_status"})
+
+
+def _battery_groups(parts):
+    """
+    EUIs per battery state from the latest state of every EUI, shaped like
+    battery_state_active.
+    """
+    latest = _latest_battery(parts)
+    if latest.empty:
+        return pd.DataFrame(columns=["battery_status", "total", "euis"])
+    latest = latest.astype({"battery_status": object})
+    euis = latest.groupby("BatteryState", sort=False, observed=True)["battery_status"].agg(list)
+    return pd.DataFrame(
+        {"battery_status": euis.index, "total": euis.str.len().to_numpy(), "euis": euis.to_numpy()}
+    )
+
+
+def _sum_occupied(parts):
+    return int(sum(part["count"].sum() for part in parts if not part.empty))
+
+
+# Routed query name -> (pipeline builder, schema, merge of the store parts,
+# filters St. Pete gateways)
+# Battery states are merged from the per EUI latest state of every store, so
+# an EUI seen by both stores counts once, with its latest state
+ROUTED_QUERIES = {
+    "gateway": (gw_pipeline, GW_SCHEMA, _sum_gateway_counts, True),
+    "gateway_download": (gw_download_pipeline, GW_DOWNLOAD_SCHEMA, _concat_parts, True),
+    "battery": (battery_download_pipeline, BATTERY_DOWNLOAD_SCHEMA, _battery_groups, False),
+    "battery_download": (
+        battery_download_pipeline,
+        BATTERY_DOWNLOAD_SCHEMA,
+        _latest_battery,
+        False,
+    ),
+    "occupied": (occupied_pipeline, OCCUPIED_SCHEMA, _sum_occupied, False),
+}
+
+
+def _store_parts(conn, start_time_obj, end_time_obj, database, collection, archive_boundary):
+    """
+    (store, collection, start, end) of every part of the window: on St. Pete
+    the window is split at archive_boundary (read with
+    st_pete_archive_boundary when not given), each part clipped to its side
+    so no uplink is read twice. Other databases have no archive.
+    """
+    if database == ST_PETE_DATABASE and archive_boundary is None:
+        archive_boundary = st_pete_archive_boundary(conn)
+    if database != ST_PETE_DATABASE or archive_boundary is None:
+        return [("active", conn[database][collection], start_time_obj, end_time_obj)]
+
+    parts = []
+    if end_time_obj >= archive_boundary:
+        start = max(start_time_obj, archive_boundary)
+        parts.append(("active", conn[database][collection], start, end_time_obj))
+    if start_time_obj < archive_boundary:
+        # Dates are stored to the millisecond
+        end = min(end_time_obj, archive_boundary - timedelta(milliseconds=1))
+        parts.append(("archive", _archive_collection(conn), start_time_obj, end))
+    if not parts:
+        # A window ending before it starts matches nothing
+        parts.append(("active", conn[database][collection], start_time_obj, end_time_obj))
+    return parts
+
+
+def _provenance(results):
+    """
+    "active", "archive" or "both" after the stores of the (store, rows)
+    results that returned rows, and None when none did.
+    """
+    stores = [store for store, df in results if not df.empty]
+    return "both" if len(stores) == 2 else (stores[0] if stores else None)
+
+
+def route_query(
+    conn, query, start_time_obj, end_time_obj, database, collection, archive_boundary=None
+):
+    """
+    Run one of ROUTED_QUERIES over the active and archive stores at once.
+    On St. Pete the window is split at archive_boundary (uplinks before it
+    live in the archive, read with st_pete_archive_boundary when not given)
+    and both parts run concurrently, each clipped to its side of the
+    boundary so no uplink is counted twice. Other databases have no
+    archive. Returns (result, provenance) where provenance is "active",
+    "archive" or "both", after the stores that returned rows, and None when
+    none did.
+    """
+    builder, schema, merge, filters_gateways = ROUTED_QUERIES[query]
+    if filters_gateways and database == ST_PETE_DATABASE:
+        builder = partial(builder, gateways=ST_PETE_GATEWAYS)
+    parts = _store_parts(conn, start_time_obj, end_time_obj, database, collection, archive_boundary)
+
+    with ThreadPoolExecutor(max_workers=len(parts)) as pool:
+        futures = [
+            (store, pool.submit(load_aggregate, store_collection, builder(start, end), schema))
+            for store, store_collection, start, end in parts
+        ]
+        results = [(store, future.result()) for store, future in futures]
+
+    print("retrieved collection successfully!!!")
+
+    return merge([df for _, df in results]), _provenance(results)
+
+
+def _routed_active(
+    conn, query, start_time_obj, end_time_obj, database, collection, archive_boundary
+):
+    """
+    route_query shaped like the *_active functions: (result, archive_flag)
+    on St. Pete, archive_flag telling that archive rows are in the result,
+    and the result alone elsewhere.
+    """
+    result, provenance = route_query(
+        conn, query, start_time_obj, end_time_obj, database, collection, archive_boundary
+    )
+    if database != ST_PETE_DATABASE:
+        return result
+    return result, provenance in ("archive", "both")
+
+
+# ========================================DASHBOARD KPIS==========================================
+
+
+# ROUTED_QUERIES run as the branches of the dashboard $facet
+DASHBOARD_FACETS = ("battery", "occupied", "gateway")
+
+
+def _facet_branch(stages, shared):
+    """
+    A KPI pipeline as a $facet branch below the shared $match: the fields of
+    its leading $match that the shared one already applies are dropped.
+    """
+    first = stages[0].get("$match", {})
+    if any(first.get(field) != value for field, value in shared.items()):
+        raise ValueError("Pipeline does not start with the shared $match {}".format(shared))
+    rest = {field: value for field, value in first.items() if field not in shared}
+    return ([{"$match": rest}] if rest else []) + stages[1:]
+
+
+def dashboard_pipeline(start_time_obj, end_time_obj, gateways=None, facets=None):
+    """
+    One $match on the window and gw uplinks followed by a $facet with a
+    branch per DASHBOARD_FACETS name (all of them by default), so every KPI
+    comes from a single scan. The result is one document holding the rows
+    of every branch, which must stay under Mongo's 16MB document limit.
+    """
+    shared = {"createdDate": {"$gte": start_time_obj, "$lte": end_time_obj}, "cmd": "gw"}
+    branches = {}
+    for name in DASHBOARD_FACETS if facets is None else facets:
+        builder, _, _, filters_gateways = ROUTED_QUERIES[name]
+        if filters_gateways:
+            stages = builder(start_time_obj, end_time_obj, gateways)
+        else:
+            stages = builder(start_time_obj, end_time_obj)
+        branches[name] = _facet_branch(stages, shared)
+    return [{"$match": shared}, {"$facet": branches}]
+
+
+def _load_facets(collection, pipeline):
+    """
+    The rows of every $facet branch, typed by its ROUTED_QUERIES schema.
+    """
+    documents = list(collection.aggregate(pipeline, allowDiskUse=True))
+    branches = documents[0] if documents else {}
+    facets = pipeline[-1]["$facet"]
+    return {name: load_cursor(branches.get(name, []), ROUTED_QUERIES[name][1]) for name in facets}
+
+
+def dashboard_kpis(conn, start_time_obj, end_time_obj, database, collection, archive_boundary=None):
+    """
+    Battery states, occupied count and gateway receptions of the window in
+    one scan per store instead of one per KPI. The window is split between
+    the stores as route_query does, the parts scanned concurrently and
+    merged with the ROUTED_QUERIES merges, so every KPI equals its *_active
+    function. Returns (kpis, provenance): kpis holds "battery" shaped like
+    battery_state_active, "occupied" as an int and "gateway" shaped like
+    agg_gw_active; provenance maps each KPI to "active", "archive", "both"
+    or None when neither store had rows.
+    """
+    gateways = ST_PETE_GATEWAYS if database == ST_PETE_DATABASE else None
+    pipeline = partial(dashboard_pipeline, gateways=gateways)
+    parts = _store_parts(conn, start_time_obj, end_time_obj, database, collection, archive_boundary)
+
+    with ThreadPoolExecutor(max_workers=len(parts)) as pool:
+        futures = [
+            (store, pool.submit(_load_facets, store_collection, pipeline(start, end)))
+            for store, store_collection, start, end in parts
+        ]
+        results = [(store, future.result()) for store, future in futures]
+    print("retrieved collection successfully!!!")
+
+    kpis, provenance = {}, {}
+    for name in DASHBOARD_FACETS:
+        frames = [(store, facets[name]) for store, facets in results]
+        kpis[name] = ROUTED_QUERIES[name][2]([df for _, df in frames])
+        provenance[name] = _provenance(frames)
+    return kpis, provenance
+
+
 # ****************************************************************************************************